@@ -0,0 +1,307 @@
+# Asyncio counterparts of the DixelStorage CRUD and worklist API, so that a
+# single event loop can keep thousands of lookups and transfers in flight.
+#
+# Requirements:
+#    Python 3.5+, unlike the rest of the package, so it's only imported
+#    explicitly, ie, "from DixelKit import AsyncStorage"
+#    aiohttp
+
+import asyncio
+import json
+import functools
+import logging
+import aiohttp
+
+from .Dixel import *
+from .DixelStorage import *
+from . import DixelTools
+from .Orthanc import Orthanc, OrthancProxy, LIST_PAGE
+from .Montage import Montage
+from .Splunk import Splunk
+
+
+def wrap(storage, concurrency=64):
+    # Pick the async wrapper for a storage
+    if isinstance(storage, OrthancProxy):
+        return AsyncOrthancProxy(storage, concurrency)
+    if isinstance(storage, Orthanc):
+        return AsyncOrthanc(storage, concurrency)
+    if isinstance(storage, Montage):
+        return AsyncMontage(storage, concurrency)
+    return AsyncDixelStorage(storage, concurrency)
+
+
+def unwrap(storage):
+    if isinstance(storage, AsyncDixelStorage):
+        return storage.storage
+    return storage
+
+
+class AsyncDixelStorage(object):
+    # Wraps a DixelStorage.  The a* methods default to running the sync method
+    # in the loop's thread pool, and HTTP backends override them with native
+    # aiohttp requests.  Everything else, including the sync API, is passed
+    # through to the wrapped storage.
+
+    def __init__(self, storage, concurrency=64):
+        self.storage = storage
+        self.concurrency = concurrency  # Requests in flight per worklist
+        self.logger = logging.getLogger()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # CRUD
+    async def aput(self, dixel):
+        return await self.run(self.storage.put, dixel)
+
+    async def aget(self, dixel, **kwargs):
+        return await self.run(self.storage.get, dixel, **kwargs)
+
+    async def adelete(self, dixel):
+        return await self.run(self.storage.delete, dixel)
+
+    async def acopy(self, dixel, dest):
+        return await self.run(self.storage.copy, dixel, unwrap(dest))
+
+    async def aupdate(self, dixel, **kwargs):
+        return await self.run(self.storage.update, dixel, **kwargs)
+
+    async def ainventory(self):
+        return await self.run(lambda: self.storage.inventory)
+
+    # Worklists
+    async def amap(self, func, worklist):
+        # Awaits func for each dixel with at most self.concurrency in flight,
+        # returns [(dixel, result, exception)]
+        items = iter(worklist)
+        res = []
+
+        async def work():
+            for dixel in items:
+                try:
+                    res.append((dixel, await func(dixel), None))
+                except Exception as e:
+                    res.append((dixel, None, e))
+
+        await asyncio.gather(*[work() for _ in range(self.concurrency)])
+        return res
+
+    async def aupdate_worklist(self, worklist, **kwargs):
+        res = set()
+        for dixel, u, e in await self.amap(lambda d: self.aupdate(d, **kwargs), worklist):
+            if e:
+                self.logger.error('Could not update {0}: {1}'.format(dixel, e))
+            elif u:
+                res.add(u)
+        return res
+
+    async def acopy_worklist(self, dest, worklist, lazy=False, results=None):
+        # Same count and {dixel: None or exception} results as copy_worklist
+        if lazy:
+            if isinstance(dest, AsyncDixelStorage):
+                inventory = await dest.ainventory()
+            else:
+                inventory = await self.run(lambda: dest.inventory)
+            worklist = set(worklist) - inventory
+
+        count = 0
+        for dixel, _, e in await self.amap(lambda d: self.acopy(d, dest), worklist):
+            if e:
+                self.logger.error('Could not copy {0}: {1}'.format(dixel, e))
+            else:
+                count = count + 1
+            if results is not None:
+                results[dixel] = e
+        return count
+
+
+class AsyncOrthanc(AsyncDixelStorage):
+
+    def __init__(self, storage, concurrency=64):
+        super(AsyncOrthanc, self).__init__(storage, concurrency)
+        self.session = None
+
+    def client(self):
+        # Created on first use, since it belongs to the running loop
+        if self.session is None:
+            auth = None
+            if self.storage.session.auth:
+                auth = aiohttp.BasicAuth(*self.storage.session.auth)
+            self.session = aiohttp.ClientSession(
+                auth=auth,
+                connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self.session
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method, path, text=False, **kwargs):
+        # Returns (status, json or text)
+        url = "{0}{1}".format(self.storage.url, path)
+        async with self.client().request(method, url, **kwargs) as r:
+            if text:
+                return r.status, await r.text()
+            return r.status, await r.json(content_type=None)
+
+    async def aput(self, dixel):
+        if dixel.level != DicomLevel.INSTANCES:
+            raise NotImplementedError("Orthanc can only put dixel instances")
+
+        headers = {'content-type': 'application/dicom'}
+        status, _ = await self.request('POST', '/instances/', data=dixel.data['file'], headers=headers)
+
+        if status == 200:
+            self.logger.debug('Added {0} successfully!'.format(dixel))
+        else:
+            self.logger.warning('Could not add {0}!'.format(dixel))
+
+    async def adelete(self, dixel):
+        status, _ = await self.request('DELETE', '/{0}/{1}'.format(str(dixel.level), dixel.id))
+
+        if status == 200:
+            self.logger.debug('Removed {0} successfully!'.format(dixel))
+        else:
+            self.logger.warning('Could not delete {0}!'.format(dixel))
+
+    async def aupdate(self, dixel, **kwargs):
+
+        if self.storage.storage and dixel.level == DicomLevel.INSTANCES:
+            # Co-located, so it's a disk read rather than a request
+            return await self.run(self.storage.update, dixel, **kwargs)
+
+        meta = dixel.meta.copy()
+
+        # Shares the wrapped Orthanc's tag cache
+        tag_cache = self.storage.tag_cache
+        key = (str(dixel.level), dixel.id)
+        tags = tag_cache.get(key)
+        if tags is None:
+            if dixel.level != DicomLevel.SERIES:
+                path = "/{0}/{1}/tags?simplify".format(str(dixel.level), dixel.id)
+            else:
+                path = "/{0}/{1}/shared-tags?simplify".format(str(dixel.level), dixel.id)
+            _, tags = await self.request('GET', path)
+            tags = DixelTools.simplify_tags(tags)
+            tag_cache.put(key, tags)
+        meta.update(tags)
+
+        if dixel.level == DicomLevel.INSTANCES:
+            meta.update(await self.ametadata(dixel))
+
+        return Dixel(dixel.id, meta=meta, level=dixel.level)
+
+    async def ametadata(self, dixel):
+        # As Orthanc.get_metadata
+        key = ('metadata', dixel.id)
+        meta = self.storage.tag_cache.get(key)
+        if meta is not None:
+            return meta
+
+        path = "/{0}/{1}/metadata".format(str(dixel.level), dixel.id)
+        status, text = await self.request('GET', path + '?expand', text=True)
+        values = json.loads(text) if status == 200 else None
+        if not isinstance(values, dict):
+            names = ['TransferSyntax', 'SopClassUid']
+            fetched = await asyncio.gather(
+                *[self.request('GET', path + '/' + name, text=True) for name in names])
+            values = dict((name, text) for name, (status, text) in zip(names, fetched)
+                          if status == 200)
+
+        sop = values.get('SopClassUid')
+        meta = {'TransferSyntaxUID': values.get('TransferSyntax', values.get('TransferSyntaxUID')),
+                'SOPClassUID': DixelTools.DICOM_SOPS.get(sop, sop)}  # Text or return val
+        self.storage.tag_cache.put(key, meta)
+        return meta
+
+    async def acopy(self, dixel, dest):
+        target = unwrap(dest)
+
+        if type(target) == Orthanc:
+            # Use push-to-peer
+            await self.request('POST', '/peers/{0}/store'.format(target.peer_name), data=dixel.id)
+
+        elif type(target) == Splunk:
+            dixel = await self.aupdate(dixel)
+            await wrap(target).aput(dixel)
+
+        else:
+            # Downloads into a FileStorage, or raises for anything else
+            await self.run(self.storage.copy, dixel, target)
+
+    async def ainventory(self):
+        # Paged like Orthanc.iter_ids
+        res = set()
+        since = 0
+        while True:
+            _, ids = await self.request('GET', '/instances',
+                                        params={'since': since, 'limit': LIST_PAGE})
+            res.update(Dixel(id=item, level=DicomLevel.INSTANCES) for item in ids)
+            if len(ids) < LIST_PAGE:
+                return res
+            since = since + len(ids)
+
+
+class AsyncOrthancProxy(AsyncOrthanc):
+    # PACS lookups and retrieves are sequences of dependent calls, so they
+    # stay on the thread pool; the rest is plain Orthanc
+
+    async def aupdate(self, dixel, **kwargs):
+        return await self.run(self.storage.update, dixel, **kwargs)
+
+    async def acopy(self, dixel, dest):
+        # Has to retrieve from the PACS before sending
+        return await self.run(self.storage.copy, dixel, unwrap(dest))
+
+
+class AsyncMontage(AsyncDixelStorage):
+
+    def __init__(self, storage, concurrency=64):
+        super(AsyncMontage, self).__init__(storage, concurrency)
+        self.session = None
+
+    def client(self):
+        if self.session is None:
+            auth = None
+            if self.storage.session.auth:
+                auth = aiohttp.BasicAuth(*self.storage.session.auth)
+            self.session = aiohttp.ClientSession(
+                auth=auth,
+                connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self.session
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def aquery(self, qdict, index="rad"):
+        # Encode like requests does: lists as repeated keys, anything else as str
+        params = []
+        for k, v in qdict.items():
+            for item in (v if isinstance(v, (list, tuple)) else [v]):
+                params.append((k, str(item)))
+
+        url = "{0}/index/{1}/search".format(self.storage.url, index)
+        async with self.client().get(url, params=params) as r:
+            return (await r.json(content_type=None))["objects"]
+
+    async def aupdate(self, dixel, time_delta=0, **kwargs):
+        qdict = self.storage.make_qdict(dixel, time_delta, **kwargs)
+        r = await self.aquery(qdict)
+        return self.storage.update_from_results(dixel, r, **kwargs)
@@ -0,0 +1,105 @@
+import binascii
+import bisect
+from .Dixel import Dixel, DicomLevel
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Orthanc ids are sha1 hex digests broken up with dashes, ie,
+# "xxxxxxxx-xxxxxxxx-xxxxxxxx-xxxxxxxx-xxxxxxxx"
+def id_to_digest(id):
+    return binascii.unhexlify(id.replace('-', ''))
+
+
+def digest_to_id(digest):
+    # numpy drops trailing nulls from fixed width bytes
+    h = binascii.hexlify(digest.ljust(20, b'\0')).decode('ascii')
+    return '-'.join(h[i:i+8] for i in range(0, 40, 8))
+
+
+class CompactInventory(object):
+    # Inventory of orthanc ids kept as a sorted array of 20-byte digests,
+    # about 20 bytes per item instead of a Dixel with four dicts apiece.
+    #
+    # Differences and intersections are vectorized with numpy when it is
+    # installed, otherwise a sorted list and bisect are used.  Dixels are only
+    # created when iterating over a result, ie, for the items that need work.
+    #
+    # worklist - compact returns the set of worklist dixels that are missing,
+    # so a compact inventory can stand in for dest.inventory in a lazy copy.
+
+    def __init__(self, digests=(), level=DicomLevel.INSTANCES, presorted=False):
+        self.level = level
+        if np is not None:
+            digests = np.asarray(digests if len(digests) else [], dtype='S20')
+            self.digests = digests if presorted else np.unique(digests)
+        else:
+            self.digests = list(digests) if presorted else sorted(set(digests))
+
+    @classmethod
+    def from_ids(cls, ids, level=DicomLevel.INSTANCES):
+        return cls([id_to_digest(id) for id in ids], level)
+
+    @classmethod
+    def from_dixels(cls, dixels, level=DicomLevel.INSTANCES):
+        return cls([id_to_digest(d.id) for d in dixels if d.level == level], level)
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __iter__(self):
+        # Materializes dixels one at a time
+        for digest in self.digests:
+            yield Dixel(digest_to_id(bytes(digest)), level=self.level)
+
+    def ids(self):
+        return [digest_to_id(bytes(digest)) for digest in self.digests]
+
+    def mask(self, digests):
+        # Which of a sequence of digests are present in this inventory
+        if np is not None:
+            digests = np.asarray(digests, dtype='S20')
+            if not len(self.digests):
+                return np.zeros(len(digests), dtype=bool)
+            idx = np.searchsorted(self.digests, digests)
+            idx[idx == len(self.digests)] = 0
+            return self.digests[idx] == digests
+        return [self.contains_digest(d) for d in digests]
+
+    def contains_digest(self, digest):
+        i = bisect.bisect_left(self.digests, digest)
+        return i < len(self.digests) and self.digests[i] == digest
+
+    def __contains__(self, dixel):
+        return bool(self.mask([id_to_digest(getattr(dixel, 'id', dixel))])[0])
+
+    def select(self, mask, keep):
+        if np is not None:
+            return CompactInventory(self.digests[mask == keep], self.level, presorted=True)
+        return CompactInventory([d for d, m in zip(self.digests, mask) if m == keep],
+                                self.level, presorted=True)
+
+    def difference(self, other):
+        return self.select(other.mask(self.digests), False)
+
+    def intersection(self, other):
+        return self.select(other.mask(self.digests), True)
+
+    def __sub__(self, other):
+        if isinstance(other, CompactInventory):
+            return self.difference(other)
+        return self.difference(CompactInventory.from_dixels(other, self.level))
+
+    def __and__(self, other):
+        if isinstance(other, CompactInventory):
+            return self.intersection(other)
+        return self.intersection(CompactInventory.from_dixels(other, self.level))
+
+    # worklist - compact
+    def __rsub__(self, other):
+        other = list(other)
+        present = self.mask([id_to_digest(d.id) for d in other])
+        return set(d for d, m in zip(other, present) if not m)
@@ -0,0 +1,110 @@
+# Requirements:
+#    gdcm python bindings for compression in a persistent worker pool
+#    otherwise gdcm tools (gdcmconv)      `brew install gdcm` on OSX
+
+import os
+import logging
+import subprocess
+import tempfile
+import threading
+import multiprocessing
+
+try:
+    import gdcm
+    HAS_GDCM = True
+except ImportError:
+    HAS_GDCM = False
+
+# gdcm can only write to a named file, so keep them off the disk where possible
+TRANSCODE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def transcode_gdcm(full_path):
+    # Runs in a pool worker, returns the file transcoded to JPEG2000 lossless.
+    # The pixel data is recompressed, the SOPInstanceUID is unchanged.
+    reader = gdcm.ImageReader()
+    reader.SetFileName(full_path)
+    if not reader.Read():
+        raise ValueError("gdcm could not read {0}".format(full_path))
+
+    change = gdcm.ImageChangeTransferSyntax()
+    change.SetTransferSyntax(gdcm.TransferSyntax(gdcm.TransferSyntax.JPEG2000Lossless))
+    change.SetInput(reader.GetImage())
+    if not change.Change():
+        raise ValueError("gdcm could not transcode {0}".format(full_path))
+
+    writer = gdcm.ImageWriter()
+    writer.SetFile(reader.GetFile())
+    writer.SetImage(change.GetOutput())
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.dcm', dir=TRANSCODE_DIR)
+    os.close(fd)
+    try:
+        writer.SetFileName(tmp_path)
+        if not writer.Write():
+            raise ValueError("gdcm could not write {0}".format(full_path))
+        with open(tmp_path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(tmp_path)
+
+
+class Compressor(object):
+    # Transcodes DICOM files to JPEG2000 lossless and returns the result as a
+    # string.
+    #
+    # Backends:
+    # - "gdcm"     -- a long-lived multiprocessing pool whose workers transcode
+    #                 with the gdcm python bindings, so there's no fork/exec or
+    #                 library load per file.  The pool is started on first use,
+    #                 call close() to stop it.
+    # - "gdcmconv" -- a bounded pool of concurrent gdcmconv processes, each
+    #                 writing the compressed file back over a pipe
+    #
+    # transcode is the function the "gdcm" workers run on each path; it has
+    # to be a module level function so that the pool can pickle it.
+
+    def __init__(self, backend=None, workers=None, transcode=transcode_gdcm):
+        self.logger = logging.getLogger()
+        self.backend = backend or ("gdcm" if HAS_GDCM else "gdcmconv")
+        self.workers = workers or multiprocessing.cpu_count()
+        self.transcode = transcode
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # Keeps concurrent copies from oversubscribing the cores
+        self.slots = threading.BoundedSemaphore(self.workers)
+
+    def compress(self, full_path):
+        if self.backend == "gdcm":
+            data = self.compress_pool(full_path)
+        else:
+            with self.slots:
+                data = self.compress_gdcmconv(full_path)
+
+        if data[128:132] != b'DICM':
+            raise ValueError("{0} produced an invalid file for {1}".format(self.backend, full_path))
+        return data
+
+    def compress_pool(self, full_path):
+        # Thread safe, concurrent copies queue up on the pool's workers
+        with self.pool_lock:
+            if self.pool is None:
+                self.logger.debug('Starting {0} transcoding workers'.format(self.workers))
+                self.pool = multiprocessing.Pool(self.workers)
+        return self.pool.apply(self.transcode, (full_path,))
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def compress_gdcmconv(self, full_path):
+        p = subprocess.Popen(['gdcmconv', '-U', '--j2k', full_path, '/dev/stdout'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        data, err = p.communicate()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, 'gdcmconv', err)
+        return data
@@ -10,7 +10,22 @@ class DicomLevel(Enum):
         return '{0}'.format(self.name.lower())
 
 
+# One shared copy of each meta/tag key seen when unpickling, so millions of
+# cached dixels don't each hold their own 'PatientID' string
+KEYS = {}
+
+
+def intern_keys(d):
+    if not d:
+        return None
+    return dict((KEYS.setdefault(k, k), v) for k, v in d.items())
+
+
 class Dixel(object):
+    # Most inventory entries only have an id and a level, so dixels use slots
+    # and only allocate tags, meta, data, and children when first used.
+
+    __slots__ = ('id', 'level', 'parent', '_tags', '_meta', '_data', '_children')
 
     def __init__(self,  id,
                         tags = None,
@@ -19,13 +34,71 @@ class Dixel(object):
                         level = DicomLevel.INSTANCES):
 
         self.id    = id            # orthanc-type id
-        self.tags  = tags or {}    # Simplified tags per orthanc
-        self.meta  = meta or {}    # ParentID, file_uuid, path, ApproxDate, other info
-        self.data  = data or {}    # Binary data, pixels, report text
+        self._tags = tags or None  # Simplified tags per orthanc
+        self._meta = meta or None  # ParentID, file_uuid, path, ApproxDate, other info
+        self._data = data or None  # Binary data, pixels, report text
         self.level = level
         self.parent = None         # Instances may have series parents, series may have study parents
-        self.children = []         # Studies have series children, series have instance children
+        self._children = None      # Studies have series children, series have instance children
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = {}
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._meta = {}
+        return self._meta
+
+    @meta.setter
+    def meta(self, value):
+        self._meta = value
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = []
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+
+    # Slots need explicit pickling; empty dicts are left out.  Also reads
+    # the __dict__ of dixels pickled before slots.  Parent and children links
+    # belong to a DixelTree, which restores them, so a pickled instance
+    # doesn't drag its whole study along.
+    def __getstate__(self):
+        return (self.id, self.level,
+                self._tags or None, self._meta or None, self._data or None)
 
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = (state['id'], state['level'],
+                     state.get('tags'), state.get('meta'), state.get('data'))
+        self.id, self.level, tags, meta, data = state
+        self.parent = None
+        self._children = None
+        self._tags = intern_keys(tags)
+        self._meta = intern_keys(meta)
+        self._data = data or None
 
     # Helpers to make dixels printable, hashable, and sortable for set operations
     def __repr__(self):
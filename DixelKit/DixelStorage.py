@@ -2,11 +2,19 @@ import pickle
 import os
 import logging
 from aenum import IntEnum
+from .SqliteCache import SqliteCache
+from .CompactInventory import CompactInventory
+from .DixelTree import DixelTree
+from . import DixelTools
 
 
 # Set this to something else to store cache files elsewhere
 TMP_CACHE_DIR = "/tmp"
 
+# Prefix for files that are still being written into a storage's directory,
+# which aren't inventoried
+TMP_PREFIX = '.dixelkit-'
+
 
 class CachePolicy(IntEnum):
     NONE = 0
@@ -24,22 +32,30 @@ class DixelStorage(object):
     # -     copy(dixel, dest) -- copy a specific item from inventory to a destination storage
     # - d = update(dixel)  -- update a (predixel) with data or meta from inventory -- same as get?
     #
-    # Includes optional disk caching (pickling) for expensive-to-compute inventories
+    # Includes optional disk caching (pickling) for expensive-to-compute inventories,
+    # or an indexed sqlite cache for very large ones
     #
     # Because dixels are hashable and dixel worklists are sets, it is straightforward to implement
     # lazy updates by differencing inventories.
 
     def __init__(self,
                  cache_pik=None,
-                 cache_policy=CachePolicy.NONE):
+                 cache_policy=CachePolicy.NONE,
+                 cache_backend="pickle"):
         self.logger = logging.getLogger()
         self.cache = {}
         self.cache_policy = cache_policy
+        self.cache_pik = None
         if cache_pik:
             self.cache_pik = os.path.join(TMP_CACHE_DIR, cache_pik)
+            if cache_backend == "sqlite":
+                self.cache_pik = os.path.splitext(self.cache_pik)[0] + ".db"
         if cache_pik and cache_policy == CachePolicy.CLEAR_AND_USE_CACHE:
             if os.path.exists(self.cache_pik):
                 os.remove(self.cache_pik)
+        if cache_pik and cache_policy != CachePolicy.NONE and cache_backend == "sqlite":
+            # Indexed, so items are read on demand instead of all at once
+            self.cache = SqliteCache(self.cache_pik)
 
     # Abstract methods -- implement these to extend
     def put(self, dixel):
@@ -57,6 +73,10 @@ class DixelStorage(object):
     def update(self, dixel, **kwargs):
         raise NotImplementedError
 
+    # Finish any puts that are buffered, called at the end of copy_worklist
+    def flush(self):
+        pass
+
     # Anything that you want to cache can be accessed with a "var" property
     # and an "initialize_var()" method that _returns_ an appropriate value
     @property
@@ -67,6 +87,22 @@ class DixelStorage(object):
         # Return the completed inventory
         raise NotImplementedError
 
+    # Instance ids only, as sorted digests, for lazy diffs of huge inventories
+    @property
+    def compact_inventory(self):
+        return self.check_cache('compact_inventory')
+
+    def initialize_compact_inventory(self):
+        return CompactInventory.from_dixels(self.inventory)
+
+    # Patient/study/series hierarchy over the inventory
+    @property
+    def tree(self):
+        return self.check_cache('tree')
+
+    def initialize_tree(self):
+        return DixelTree.from_inventory(self.inventory)
+
     # Generic functions
     def check_cache(self, item):
 
@@ -93,11 +129,15 @@ class DixelStorage(object):
 
     # File inventories in particular can be expensive to compute
     def save_cache(self):
-        if self.cache_policy > 0 and self.cache_pik:
+        if isinstance(self.cache, SqliteCache):
+            self.cache.commit()
+        elif self.cache_policy > 0 and self.cache_pik:
             with open(self.cache_pik, 'wb') as f:
                 pickle.dump(self.cache, f)
 
     def load_cache(self):
+        if isinstance(self.cache, SqliteCache):
+            return
         if self.cache_policy != CachePolicy.NONE and \
                 self.cache_pik and \
                 os.path.exists(self.cache_pik):
@@ -107,14 +147,41 @@ class DixelStorage(object):
     def view_inventory(self):
         logging.info(sorted(self.inventory))
 
-    def delete_inventory(self):
+    def delete_inventory(self, **kwargs):
         worklist = self.inventory
-        self.delete_worklist(worklist)
+        res = self.delete_worklist(worklist, **kwargs)
         self.cache['inventory'] = None
-
-    def copy_inventory(self, dest, lazy=False):
-        worklist = self.inventory
-        return self.copy_worklist(dest, worklist, lazy)
+        self.cache['compact_inventory'] = None
+        self.cache['tree'] = None
+        return res
+
+    def copy_inventory(self, dest, lazy=False, compact=False, reconcile=False, **kwargs):
+        # With compact, the lazy diff runs on both compact inventories and
+        # only the missing instances are made into dixels.  With reconcile,
+        # the trees are compared by digest instead.
+        if lazy and reconcile:
+            try:
+                return self.copy_worklist(dest, self.reconcile(dest), **kwargs)
+            finally:
+                # dest has changed, so its tree has to be rebuilt next time
+                dest.cache['tree'] = None
+        if compact:
+            worklist = self.compact_inventory
+        else:
+            worklist = self.inventory
+        return self.copy_worklist(dest, worklist, lazy, **kwargs)
+
+    def reconcile(self, dest, level=None):
+        # What dest is missing, found by comparing study and series digests
+        # and only descending where they differ.  Falls back to a full
+        # inventory diff where either side can't build a tree.
+        try:
+            src_tree, dest_tree = self.tree, dest.tree
+        except NotImplementedError:
+            src_tree = dest_tree = None
+        if not src_tree or not dest_tree:
+            return set(self.inventory) - dest.inventory
+        return src_tree.reconcile(dest_tree, level)
 
     def get_worklist(self, worklist, lazy=False, **kwargs):
 
@@ -129,26 +196,100 @@ class DixelStorage(object):
         for dixel in worklist:
             self.delete(dixel)
 
-    def copy_worklist(self, dest, worklist, lazy=False):
+    def copy_worklist(self, dest, worklist, lazy=False, workers=1, queue_size=None, results=None,
+                      journal=None):
+        # With workers > 1, copies run concurrently on a thread pool with at
+        # most queue_size dixels waiting.  Failures are logged and skipped
+        # instead of raised.  Either way, pass a dict as results to collect
+        # {dixel: None or exception} for each copy.
+        #
+        # With a Journal, finished copies are recorded as they complete and
+        # anything already in the journal is skipped, so a restarted job
+        # picks up where it left off.  A lazy copy still diffs against dest's
+        # inventory, so restart with lazy=False to rely on the journal alone.
+
+        if journal is not None:
+            finished = journal.done('copy')
+            if isinstance(worklist, CompactInventory):
+                worklist = worklist - CompactInventory.from_ids(finished, worklist.level)
+            elif isinstance(worklist, (set, frozenset)):
+                worklist = set(dixel for dixel in worklist if dixel.id not in finished)
+            else:
+                worklist = (dixel for dixel in worklist if dixel.id not in finished)
 
         if lazy:
-            # logging.debug("All src:  {0} dixels\n   {1}".format(len(worklist), sorted(worklist)))
-            # logging.debug("All dest: {0} dixels\n   {1}".format(
-            #     len(dest.inventory), sorted(dest.inventory)))
-            worklist = worklist - dest.inventory
-            # logging.debug("Lazy:     {0} dixels\n   {1}".format(len(worklist), sorted(worklist)))
+            if isinstance(worklist, CompactInventory):
+                worklist = worklist - dest.compact_inventory
+            elif isinstance(worklist, (set, frozenset)):
+                # logging.debug("All src:  {0} dixels\n   {1}".format(len(worklist), sorted(worklist)))
+                # logging.debug("All dest: {0} dixels\n   {1}".format(
+                #     len(dest.inventory), sorted(dest.inventory)))
+                worklist = worklist - dest.inventory
+                # logging.debug("Lazy:     {0} dixels\n   {1}".format(len(worklist), sorted(worklist)))
+            else:
+                # Streaming worklist, so filter items as they arrive
+                inventory = dest.inventory
+                worklist = (dixel for dixel in worklist if dixel not in inventory)
 
         count = 0
-        for dixel in worklist:
-            count = count + 1
-            self.copy(dixel, dest)
 
-        return count
-
-    def update_worklist(self, worklist, **kwargs):
+        try:
+            if workers == 1:
+                for dixel in worklist:
+                    count = count + 1
+                    self.copy(dixel, dest)
+                    if journal is not None:
+                        journal.record('copy', dixel)
+                    if results is not None:
+                        results[dixel] = None
+                return count
+
+            copies = DixelTools.threaded_map(lambda dixel: self.copy(dixel, dest),
+                                             worklist, workers, queue_size)
+            for dixel, _, e in copies:
+                if e:
+                    self.logger.error('Could not copy {0}: {1}'.format(dixel, e))
+                else:
+                    count = count + 1
+                    if journal is not None:
+                        journal.record('copy', dixel)
+                if results is not None:
+                    results[dixel] = e
+            return count
+
+        finally:
+            # Even on errors, so that finished puts aren't left as temp files
+            dest.flush()
+
+    def update_worklist(self, worklist, journal=None, workers=1, **kwargs):
+        # With a Journal, each update result is recorded, and items that
+        # were already updated are returned from the journal instead.
+        # With workers > 1, updates run on a thread pool like copy_worklist,
+        # and failures are logged and skipped.
         res = set()
+        finished = journal.done('update') if journal is not None else {}
+
+        todo = []
         for dixel in worklist:
-            u = self.update(dixel, **kwargs)
+            if dixel.id in finished:
+                if finished[dixel.id]:
+                    res.add(finished[dixel.id])
+            else:
+                # Keep the id, as some updates (ie, PACS lookups) change it
+                todo.append((dixel.id, dixel))
+
+        update = lambda item: self.update(item[1], **kwargs)
+        if workers == 1:
+            updates = ((item, update(item), None) for item in todo)
+        else:
+            updates = DixelTools.threaded_map(update, todo, workers)
+
+        for (id, dixel), u, e in updates:
+            if e:
+                self.logger.error('Could not update {0}: {1}'.format(dixel, e))
+                continue
+            if journal is not None:
+                journal.record('update', id, u)
             if u:
                 res.add(u)
         return res
\ No newline at end of file
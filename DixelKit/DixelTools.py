@@ -3,12 +3,19 @@ import csv
 import os
 import re
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 from datetime import datetime, timedelta
 from dateutil import parser as dateutil_parser
 from bs4 import BeautifulSoup   # For report anonymization
-from Dixel import *
+from .Dixel import *
 
-from StructuredTags import simplify_tags
+from .StructuredTags import simplify_tags
 
 DICOM_SOPS = {
     '1.2.840.10008.5.1.4.1.1.2':     'CT Image Storage',
@@ -133,6 +140,123 @@ def save_text_corpus(out_dir, worklist):
             f.write(anon_text)
 
 
+class MemoryBudget(object):
+    # Blocks callers until their bytes fit under a shared limit.  An item
+    # larger than the whole limit is let through once nothing else is in flight.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        if self.limit is None:
+            yield
+            return
+
+        size = min(size, self.limit)
+        with self.cond:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self.cond.wait()
+            self.in_flight += size
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= size
+                self.cond.notify_all()
+
+
+class LRU(object):
+    # Thread-safe dict that keeps only the maxsize most recently used items
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+
+def chunks(items, n):
+    # Lists of up to n items from any iterable
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def threaded_map(func, items, workers=8, queue_size=None):
+    # Calls func on each item from a pool of threads and yields
+    # (item, result, exception) as each one finishes, in no particular order.
+    # At most queue_size items are read ahead of the workers, so a slow
+    # destination holds back a streamed worklist instead of buffering it.
+
+    todo = queue.Queue(maxsize=queue_size or 2 * workers)
+    finished = queue.Queue()
+    done = object()
+    feed_error = []
+
+    def feed():
+        try:
+            for item in items:
+                todo.put(item)
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            for _ in range(workers):
+                todo.put(done)
+
+    def work():
+        while True:
+            item = todo.get()
+            if item is done:
+                finished.put(done)
+                return
+            try:
+                finished.put((item, func(item), None))
+            except Exception as e:
+                finished.put((item, None, e))
+
+    threads = [threading.Thread(target=feed)] + \
+              [threading.Thread(target=work) for _ in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    remaining = workers
+    while remaining:
+        r = finished.get()
+        if r is done:
+            remaining = remaining - 1
+        else:
+            yield r
+
+    if feed_error:
+        raise feed_error[0]
+
+
 """
 Patients are identified as the SHA-1 hash of their PatientID tag (0010,0020).
 Studies are identified as the SHA-1 hash of the concatenation of their PatientID tag (0010,0020) and their StudyInstanceUID tag (0020,000d).
@@ -141,8 +265,10 @@ Instances are identified as the SHA-1 hash of the concatenation of their Patient
   -- http://book.orthanc-server.com/faq/orthanc-ids.html
 """
 
-def orthanc_id(PatientID, StudyInstanceUID, SeriesInstanceUID=None, SOPInstanceUID=None):
-    if not SeriesInstanceUID:
+def orthanc_id(PatientID, StudyInstanceUID=None, SeriesInstanceUID=None, SOPInstanceUID=None):
+    if not StudyInstanceUID:
+        s = PatientID
+    elif not SeriesInstanceUID:
         s = "|".join([PatientID, StudyInstanceUID])
     elif not SOPInstanceUID:
         s = "|".join([PatientID, StudyInstanceUID, SeriesInstanceUID])
@@ -0,0 +1,229 @@
+import logging
+from hashlib import sha1
+from .Dixel import Dixel, DicomLevel
+from . import DixelTools
+
+# DicomLevel's auto() values aren't in definition order on Python 2
+RANK = {DicomLevel.INSTANCES: 0,
+        DicomLevel.SERIES:    1,
+        DicomLevel.STUDIES:   2,
+        DicomLevel.PATIENTS:  3}
+
+
+class DixelTree(object):
+    # Patient -> study -> series -> instance index over an inventory.
+    #
+    # Parent nodes are dixels with their children (and each child's parent)
+    # filled in, and meta['InstanceCount'] and meta['Size'] (bytes, where
+    # known) for everything below them.  Instance nodes are the inventory's
+    # own dixels.
+    #
+    # rollup() and difference() return mixed-level worklists that use a
+    # whole series or study wherever it is entirely selected or missing, so
+    # a copy or delete makes one request per node instead of per instance.
+    #
+    # Each parent also has a Merkle-style digest of its sorted child ids
+    # (and their digests), computed on demand and kept in meta['Digest'].
+    # difference() and reconcile() only descend into subtrees whose digests
+    # differ.
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.nodes = {}     # id: dixel, for every level
+        self.roots = []     # patient dixels
+
+    def node(self, id, level, parent=None):
+        d = self.nodes.get(id)
+        if d is None:
+            d = Dixel(id, meta={'InstanceCount': 0, 'Size': 0}, level=level)
+            self.nodes[id] = d
+            if parent is None:
+                self.roots.append(d)
+            else:
+                d.parent = parent
+                parent.children.append(d)
+        return d
+
+    def add(self, dixel, patient_id, study_id, series_id, size=0):
+        # Add an instance under its (orthanc) patient, study, and series ids
+        if dixel.id in self.nodes:
+            return
+        patient = self.node(patient_id, DicomLevel.PATIENTS)
+        study = self.node(study_id, DicomLevel.STUDIES, patient)
+        series = self.node(series_id, DicomLevel.SERIES, study)
+        dixel.parent = series
+        series.children.append(dixel)
+        self.nodes[dixel.id] = dixel
+
+        node = series
+        while node is not None:
+            node.meta['InstanceCount'] += 1
+            node.meta['Size'] += size
+            node.meta.pop('Digest', None)
+            node = node.parent
+
+    def remove(self, dixel, size=0):
+        # Remove an instance, and any parents that are left empty
+        d = self.nodes.get(getattr(dixel, 'id', dixel))
+        if d is None or d.level != DicomLevel.INSTANCES:
+            return
+        del self.nodes[d.id]
+        node = d.parent
+        node.children.remove(d)
+        d.parent = None
+
+        while node is not None:
+            node.meta['InstanceCount'] -= 1
+            node.meta['Size'] -= size
+            node.meta.pop('Digest', None)
+            parent = node.parent
+            if not node.children:
+                del self.nodes[node.id]
+                if parent is None:
+                    self.roots.remove(node)
+                else:
+                    parent.children.remove(node)
+            node = parent
+
+    def digest(self, node):
+        if node.level == DicomLevel.INSTANCES:
+            return node.id.encode('utf-8')
+        d = node.meta.get('Digest')
+        if d is None:
+            h = sha1()
+            for child in sorted(node.children):
+                h.update(child.id.encode('utf-8'))
+                if child.level != DicomLevel.INSTANCES:
+                    h.update(self.digest(child))
+            d = h.digest()
+            node.meta['Digest'] = d
+        return d
+
+    def __iter__(self):
+        # Every node, parents before children
+        stack = list(reversed(self.roots))
+        while stack:
+            d = stack.pop()
+            yield d
+            if d.level != DicomLevel.INSTANCES:
+                stack.extend(reversed(d.children))
+
+    # Dixels don't pickle their links, so keep them as parent ids
+    def __getstate__(self):
+        return [(d, d.parent.id if d.parent is not None else None) for d in self]
+
+    def __setstate__(self, state):
+        self.__init__()
+        for d, parent_id in state:
+            if parent_id is None:
+                self.roots.append(d)
+            else:
+                d.parent = self.nodes[parent_id]
+                d.parent.children.append(d)
+            self.nodes[d.id] = d
+
+    @classmethod
+    def from_inventory(cls, inventory):
+        # Instances need PatientID and Study/Series UIDs in their meta, as
+        # FileStorage provides; anything else is skipped
+        tree = cls()
+        for dixel in inventory:
+            meta = dixel.meta
+            try:
+                patient_id = DixelTools.orthanc_id(meta['PatientID'])
+                study_id = DixelTools.orthanc_id(meta['PatientID'],
+                                                 meta['StudyInstanceUID'])
+                series_id = DixelTools.orthanc_id(meta['PatientID'],
+                                                  meta['StudyInstanceUID'],
+                                                  meta['SeriesInstanceUID'])
+            except KeyError:
+                continue
+            size = meta['stat'][0] if 'stat' in meta else meta.get('FileSize', 0)
+            tree.add(dixel, patient_id, study_id, series_id, size)
+        return tree
+
+    def __len__(self):
+        return sum(d.meta['InstanceCount'] for d in self.roots)
+
+    def __contains__(self, dixel):
+        return getattr(dixel, 'id', dixel) in self.nodes
+
+    def count(self, dixel):
+        d = self.nodes.get(getattr(dixel, 'id', dixel))
+        if d is None:
+            return 0
+        return d.meta.get('InstanceCount', 1) if d.level != DicomLevel.INSTANCES else 1
+
+    def instances(self, dixel):
+        # All of the instance dixels under a node
+        if dixel.level == DicomLevel.INSTANCES:
+            yield dixel
+            return
+        for child in dixel.children:
+            for d in self.instances(child):
+                yield d
+
+    def rollup(self, worklist, level=DicomLevel.STUDIES):
+        # Replace instances with the highest parent, up to level, that has
+        # all of its instances in the worklist.  Instances that aren't in the
+        # tree are returned as-is.
+        selected = {}   # node id: number of selected instances below it
+        res = set()
+        worklist = set(worklist)
+        for dixel in worklist:
+            d = self.nodes.get(dixel.id)
+            if d is None or d.level != DicomLevel.INSTANCES:
+                res.add(dixel)
+                continue
+            node = d.parent
+            while node is not None:
+                selected[node.id] = selected.get(node.id, 0) + 1
+                node = node.parent
+
+        def visit(node):
+            n = selected.get(node.id, 0)
+            if not n:
+                return
+            if RANK[node.level] <= RANK[level] and n == node.meta['InstanceCount']:
+                res.add(node)
+            elif node.level == DicomLevel.SERIES:
+                res.update(d for d in node.children if d in worklist)
+            else:
+                for child in node.children:
+                    visit(child)
+
+        for root in self.roots:
+            visit(root)
+
+        self.logger.debug('Rolled up {0} to {1} items'.format(len(worklist), len(res)))
+        return res
+
+    def difference(self, other, level=DicomLevel.STUDIES):
+        # Instances here that are missing from other, as whole studies or
+        # series (up to level) where other has none of them.  Nodes are
+        # compared by digest, so a series with the same number of different
+        # instances is still descended into.
+        return self.reconcile(other, level)
+
+    def reconcile(self, other, level=None):
+        # Subtrees with matching digests are skipped without looking at
+        # their children.  Missing nodes are returned whole up to level, or
+        # as instances when level is None.
+        res = set()
+
+        def visit(node):
+            o = other.nodes.get(node.id)
+            if o is not None and other.digest(o) == self.digest(node):
+                return
+            if node.level == DicomLevel.INSTANCES:
+                res.add(node)
+                return
+            if o is None and level is not None and RANK[node.level] <= RANK[level]:
+                res.add(node)
+                return
+            for child in node.children:
+                visit(child)
+
+        for root in self.roots:
+            visit(root)
+        return res
@@ -1,27 +1,85 @@
 # Requirements:
-#    gdcm for compression       `brew install gdcm` on OSX
-#    libmagic for file typing   `brew install libmagic` on OSX
+#    gdcm (python bindings or gdcmconv) for compression, see Compressor
 
 import os
-import magic
 import dicom
-import itertools
 from hashlib import sha1
-import subprocess
+import logging
+import multiprocessing
+import zlib
+import sqlite3
+import time
+import tempfile
+import threading
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    from scandir import scandir
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    # Not on Linux, or not installed, so watch() falls back to polling
+    INotify = None
+
+from .Dixel import *
+from .DixelStorage import *
+from . import DixelTools
+from .Orthanc import Orthanc
+from .Compressor import Compressor
+
+
+# Elements longer than this are skipped over rather than read when parsing headers
+HEADER_DEFER_SIZE = 1024
+
+# (7fe0,0010) as it appears on disk in little and big endian files
+PIXEL_DATA_TAGS = ('\xe0\x7f\x10\x00', '\x7f\xe0\x00\x10')
+
+DEFLATED_TRANSFER_SYNTAX = '1.2.840.10008.1.2.1.99'
+
+# Orthanc index schema values for the co-located fast path
+ORTHANC_INSTANCE_RESOURCE = 4
+ORTHANC_DICOM_ATTACHMENT = 1
+ORTHANC_UNCOMPRESSED = 1
+
+# Bytes per write when putting streamed files
+WRITE_CHUNK = 1024 * 1024
+
+# Puts per fsync pass
+FSYNC_BATCH = 64
+
+# Seconds before watch retries a file whose copy failed
+WATCH_RETRY = 60.0
+
+# Shared by all FileStorages, caps the bytes that concurrent copies may have
+# in flight at once.  Set the limit to None to disable.
+IN_FLIGHT_BYTES = DixelTools.MemoryBudget(512 * 1024 * 1024)
 
-from Dixel import *
-from DixelStorage import *
-import DixelTools
-from Orthanc import Orthanc
 
 class FileStorage(DixelStorage):
 
     def __init__(self,
                  loc,
-                 cache_policy=CachePolicy.USE_CACHE):
+                 cache_policy=CachePolicy.USE_CACHE,
+                 workers=1,
+                 chunksize=64,
+                 compressor=None,
+                 checksum=False,
+                 cache_backend="pickle"):
         self.loc = loc
+        self.compressor = compressor or Compressor()
+        self.checksum = checksum    # Confirm duplicate files by content before skipping them
+        self.duplicates = {}        # id: [paths] skipped by the last dedup
+        self.conflicts = {}         # id: [paths] with the same id but different content
+        self.workers = workers      # Header parsing processes, None for one per core
+        self.chunksize = chunksize  # Predixels handed to a worker at a time
+        self.unsynced = []          # (temp path, full path, dixel) waiting for flush
+        self.appended = False       # Files added to the cache since it was saved
+        self.put_lock = threading.RLock()
         cache_pik = "{0}.pik".format(sha1(self.loc).hexdigest()[0:8])
-        super(FileStorage, self).__init__(cache_pik=cache_pik, cache_policy=cache_policy)
+        super(FileStorage, self).__init__(cache_pik=cache_pik,
+                                          cache_policy=cache_policy,
+                                          cache_backend=cache_backend)
 
     # Mapping from orthanc file_uuid's to directory paths
     def orthanc_path(self, file_uuid):
@@ -30,29 +88,90 @@ class FileStorage(DixelStorage):
             return ipath
         return False
 
+    # Attachment uuids straight from the index of a co-located Orthanc whose
+    # StorageDirectory is loc.  Returns {instance id: file_uuid} for all
+    # instances, or just for ids, skipping attachments stored compressed.
+    # Returns None if the index can't be read.
+    def orthanc_attachments(self, ids=None, index_path=None):
+        index_path = index_path or os.path.join(self.loc, 'index')
+        if not os.path.isfile(index_path):
+            self.logger.debug('No Orthanc index at {0}'.format(index_path))
+            return
+
+        q = """SELECT r.publicId, a.uuid FROM Resources r
+               JOIN AttachedFiles a ON a.id = r.internalId
+               WHERE r.resourceType = ? AND a.fileType = ? AND a.compressionType = ?"""
+        args = [ORTHANC_INSTANCE_RESOURCE, ORTHANC_DICOM_ATTACHMENT, ORTHANC_UNCOMPRESSED]
+
+        res = {}
+        try:
+            # Don't wait on the lock, a running Orthanc never lets it go
+            conn = sqlite3.connect(index_path, timeout=0)
+            try:
+                if ids is None:
+                    res.update(conn.execute(q, args))
+                else:
+                    ids = list(ids)
+                    # Stay under sqlite's bound parameter limit
+                    for i in range(0, len(ids), 500):
+                        chunk = ids[i:i+500]
+                        res.update(conn.execute(
+                            q + " AND r.publicId IN ({0})".format(",".join("?" * len(chunk))),
+                            args + chunk))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # A running Orthanc holds an exclusive lock on its index
+            self.logger.warning('Could not read Orthanc index {0}, using REST instead: {1}'.format(
+                index_path, e))
+            return
+
+        return res
+
+    # Orthanc style simplified tags for a file, for metadata extraction
+    # without the REST api
+    def read_tags(self, full_path):
+        tags, _ = read_header(full_path)
+        if tags is None:
+            return
+        simple = simplify_dataset(tags)
+        simple['TransferSyntaxUID'] = tags.file_meta.TransferSyntaxUID
+        return simple
+
+    def iter_preinventory(self):
+        # Depth-first walk that yields predixels as each directory is scanned,
+        # only the directories still to be visited are held in memory
+        dirs = [self.loc]
+        while dirs:
+            path = dirs.pop()
+            try:
+                entries = scandir(path)
+            except OSError as e:
+                self.logger.warning('Could not scan {0}: {1}'.format(path, e))
+                continue
+
+            for entry in entries:
+                # Like os.walk, don't descend into linked directories
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                    continue
+
+                if entry.name.startswith(TMP_PREFIX):
+                    # Unfinished put
+                    continue
+
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # Removed since the scan
+                    continue
+
+                yield make_predixel(entry.path, st)
+
     def initialize_preinventory(self):
         self.logger.debug('Walking file tree')
-        all_paths = []
-        all_files = []
-        for paths, _, files in os.walk(self.loc):
-            all_paths = all_paths + list(itertools.repeat(paths, times=len(files)))
-            all_files = all_files + files
-
-        preinventory = set()
-
-        for path, fn in zip(all_paths, all_files):
-            full_path = os.path.join(path, fn)
-
-            id = full_path
-            meta = {'fn': fn,
-                    'path': path,
-                    'full_path': full_path}
-
-            preinventory.add(Dixel(id, meta=meta))
-
-        # self.logger.debug(preinventory)
-
-        return preinventory
+        return set(self.iter_preinventory())
 
     @property
     def preinventory(self):
@@ -64,44 +183,374 @@ class FileStorage(DixelStorage):
         # Get predixel file data
         preinventory = self.preinventory
 
-        # Update predixels
-        return self.update_worklist(preinventory)
+        # Update predixels, keeping each file's stat next to its parse so
+        # that refresh_inventory can skip unchanged files
+        file_index = {}
+        for predixel, dixel in self.parse_worklist(preinventory):
+            file_index[predixel.id] = (predixel.meta['stat'], dixel)
+        self.cache['file_index'] = file_index
+
+        return set(dixel for _, dixel in file_index.itervalues() if dixel)
+
+    def iter_inventory(self):
+        # Stream parsed dixels while the walk is still running, without
+        # building or caching the whole inventory
+        for _, dixel in self.parse_worklist(self.iter_preinventory()):
+            if dixel:
+                yield dixel
+
+    def refresh_inventory(self):
+        # Re-stat the tree and re-parse only new or changed files
+
+        if not self.cache:
+            self.load_cache()
+
+        file_index = self.cache.get('file_index')
+        if not file_index:
+            # Nothing to compare against, so build it from scratch
+            return self.inventory
+
+        preinventory = self.initialize_preinventory()
+        current = set(predixel.id for predixel in preinventory)
+
+        removed = [full_path for full_path in file_index if full_path not in current]
+        for full_path in removed:
+            del file_index[full_path]
+
+        changed = [predixel for predixel in preinventory
+                   if file_index.get(predixel.id, (None, None))[0] != predixel.meta['stat']]
+        for predixel, dixel in self.parse_worklist(changed):
+            file_index[predixel.id] = (predixel.meta['stat'], dixel)
+
+        self.logger.debug('Refreshed {0}: {1} new or changed, {2} removed'.format(
+            self.loc, len(changed), len(removed)))
+
+        self.cache['file_index'] = file_index
+        self.cache['preinventory'] = preinventory
+        self.cache['inventory'] = set(dixel for _, dixel in file_index.itervalues() if dixel)
+        self.cache['compact_inventory'] = None
+        self.cache['tree'] = None
+        self.save_cache()
+
+        return self.cache['inventory']
+
+    def parse_worklist(self, worklist):
+        # Yields (predixel, dixel or None) pairs, fanning the header parsing
+        # out across a process pool unless workers == 1
+        if self.workers == 1:
+            for predixel in worklist:
+                yield predixel, update_file(predixel)
+            return
+
+        self.logger.debug('Parsing headers with {0} workers'.format(
+            self.workers or multiprocessing.cpu_count()))
+
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            for pair in pool.imap_unordered(parse_file, worklist, self.chunksize):
+                yield pair
+        finally:
+            pool.close()
+            pool.join()
 
     def update(self, dixel):
-
-        magic_type = magic.from_file(dixel.meta['full_path'], mime=True)
-        if magic_type == 'application/dicom':
-
-            tags = dicom.read_file(dixel.meta['full_path'])
-            # self.logger.debug(tags)
-
-            meta = { 'PatientID'         : tags[0x0010, 0x0020].value,
-                     'StudyInstanceUID'  : tags[0x0020, 0x000d].value,
-                     'SeriesInstanceUID' : tags[0x0020, 0x000e].value,
-                     'SOPInstanceUID'    : tags[0x0008, 0x0018].value,
-                     'TransferSyntaxUID' : tags.file_meta.TransferSyntaxUID,
-                     'MediaStorage'      : tags.file_meta.MediaStorageSOPClassUID,
-                     'AccessionNumber'   : tags[0x0008, 0x0050].value,
-                     'HasPixels'         : 'PixelData' in tags
-                    }
-
+        return update_file(dixel)
+
+    def dedup(self, worklist, checksum=False):
+        # Yields one dixel per orthanc id, so the same instance exported under
+        # several paths is only handled once.  The skipped paths are collected
+        # in self.duplicates.  With checksum, a copy whose content differs from
+        # the first one seen is reported in self.conflicts as well.
+        self.duplicates = {}
+        self.conflicts = {}
+        seen = {}       # id: path of first copy
+        checksums = {}  # path: checksum, only for ids that have duplicates
+
+        for dixel in worklist:
+            first = seen.get(dixel.id)
+            if first is None:
+                seen[dixel.id] = dixel.meta['full_path']
+                yield dixel
+                continue
+
+            full_path = dixel.meta['full_path']
+            self.duplicates.setdefault(dixel.id, []).append(full_path)
+
+            if checksum:
+                if first not in checksums:
+                    checksums[first] = file_checksum(first)
+                if file_checksum(full_path) != checksums[first]:
+                    self.logger.warning('{0} has the same id as {1} but different content'.format(
+                        full_path, first))
+                    self.conflicts.setdefault(dixel.id, [first]).append(full_path)
+
+        if self.duplicates:
+            self.logger.info('Skipped {0} duplicate files of {1} instances'.format(
+                sum(len(paths) for paths in self.duplicates.itervalues()),
+                len(self.duplicates)))
+
+    def iter_files(self, worklist=None):
+        # Parsed files in path order, or just those whose id is in worklist.
+        # The inventory keeps one dixel per id, but this yields every file,
+        # so dedup can report the extra copies and always keeps the same one.
+        inventory = self.inventory
+        file_index = self.cache.get('file_index')
+        if not file_index:
+            for dixel in (inventory if worklist is None else worklist):
+                yield dixel
+            return
+
+        if isinstance(file_index, dict):
+            items = sorted(file_index.iteritems())
+        else:
+            # Already paged in key order
+            items = file_index.iteritems()
+        for _, (_, dixel) in items:
+            if dixel and (worklist is None or dixel in worklist):
+                yield dixel
+
+    def copy_inventory(self, dest, lazy=False, compact=False, reconcile=False, **kwargs):
+        # Files need their paths, so only the destination side is compact.
+        # The diff runs on the inventory, then the missing ids are expanded
+        # back into every file that has them.
+        if not lazy:
+            worklist = None
+        elif reconcile:
+            worklist = self.reconcile(dest)
+        elif compact:
+            worklist = self.inventory - dest.compact_inventory
+        else:
+            worklist = self.inventory - dest.inventory
+
+        try:
+            return self.copy_worklist(dest, self.iter_files(worklist), **kwargs)
+        finally:
+            if lazy and reconcile:
+                # dest has changed, so its tree has to be rebuilt next time
+                dest.cache['tree'] = None
+
+    def copy_worklist(self, dest, worklist, lazy=False, **kwargs):
+        # Transfer each unique instance once
+        return super(FileStorage, self).copy_worklist(
+            dest, self.dedup(worklist, self.checksum), lazy, **kwargs)
+
+    def watch(self, dest, settle=2.0, poll_interval=5.0, stop=None):
+        # Copy instances to dest as they land under loc, until stop (a
+        # threading.Event) is set.  Uses inotify where available, otherwise
+        # polls the tree every poll_interval seconds.  A file is only picked up
+        # once it has been left alone for settle seconds, so partially written
+        # files are never sent.  Failed copies are logged and retried after
+        # WATCH_RETRY seconds.  Returns the number of instances copied.
+
+        if not self.cache:
+            self.load_cache()
+        file_index = self.cache.get('file_index')
+        inventory = self.cache.get('inventory')
+
+        seen = set(d.id for d in inventory) if inventory else set()
+        pending = {}   # full_path: time of last change
+        count = 0
+
+        if INotify:
+            self.logger.info('Watching {0} with inotify'.format(self.loc))
+            changes = self.inotify_changes(stop)
+        else:
+            self.logger.info('Polling {0} every {1}s'.format(self.loc, poll_interval))
+            changes = self.polled_changes(poll_interval, stop)
+
+        try:
+            for changed in changes:
+
+                now = time.time()
+                for full_path in changed:
+                    pending[full_path] = now
+
+                ready = [full_path for full_path, t in pending.items() if now - t >= settle]
+                for full_path in ready:
+                    del pending[full_path]
+
+                    try:
+                        predixel = make_predixel(full_path, os.stat(full_path))
+                    except OSError:
+                        # Gone again
+                        continue
+
+                    dixel = update_file(predixel)
+                    if file_index is not None:
+                        file_index[full_path] = (predixel.meta['stat'], dixel)
+                    if not dixel or dixel.id in seen:
+                        continue
+                    seen.add(dixel.id)
+                    if inventory is not None:
+                        inventory.add(dixel)
+
+                    try:
+                        self.copy(dixel, dest)
+                    except Exception as e:
+                        # Keep watching, and try this one again later
+                        self.logger.error('Could not copy {0}, retrying in {1}s: {2}'.format(
+                            full_path, WATCH_RETRY, e))
+                        seen.discard(dixel.id)
+                        pending[full_path] = now + WATCH_RETRY - settle
+                        continue
+                    count = count + 1
+
+        finally:
+            if file_index is not None:
+                self.cache['file_index'] = file_index
+            self.save_cache()
+
+        return count
+
+    def inotify_changes(self, stop, timeout=1.0):
+        # Yields lists of paths written or moved into the tree, or an empty
+        # list every timeout seconds so that the caller can settle pending files
+        mask = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE
+        inotify = INotify()
+        wds = {}
+
+        def add_watches(top):
+            # New directories may already have contents by the time they're watched
+            found = []
+            dirs = [top]
+            while dirs:
+                path = dirs.pop()
+                try:
+                    wds[inotify.add_watch(path, mask)] = path
+                    entries = scandir(path)
+                except OSError:
+                    continue
+                for entry in entries:
+                    if entry.is_dir() and not entry.is_symlink():
+                        dirs.append(entry.path)
+                    elif top != self.loc:
+                        found.append(entry.path)
+            return found
+
+        add_watches(self.loc)
+        try:
+            while not (stop and stop.is_set()):
+                changed = []
+                for event in inotify.read(timeout=int(timeout * 1000)):
+                    full_path = os.path.join(wds.get(event.wd, ''), event.name)
+                    if event.mask & inotify_flags.ISDIR:
+                        if event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                            changed.extend(add_watches(full_path))
+                    elif event.mask & (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO):
+                        changed.append(full_path)
+                yield changed
+        finally:
+            inotify.close()
+
+    def polled_changes(self, poll_interval, stop):
+        # Yields lists of paths that are new or whose stat changed since the
+        # last scan
+        stats = dict((d.id, d.meta['stat']) for d in self.iter_preinventory())
+        while not (stop and stop.is_set()):
+            if stop:
+                stop.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            changed = []
+            for predixel in self.iter_preinventory():
+                if stats.get(predixel.id) != predixel.meta['stat']:
+                    stats[predixel.id] = predixel.meta['stat']
+                    changed.append(predixel.id)
+            yield changed
+
+    def put(self, dixel):
+        # Write data['file'] (a string, an open file, or an iterator of
+        # chunks, as Orthanc.get returns) to loc/xx/yy/<orthanc id>, the
+        # layout orthanc_path reads.  The file is written to a temp name and
+        # renamed into place by flush(), which runs every FSYNC_BATCH puts,
+        # so that one fsync pass covers the whole batch.  Returns the path
+        # the file will have.
+
+        f = tempfile.NamedTemporaryFile(prefix=TMP_PREFIX, dir=self.loc, delete=False)
+        try:
+            with f:
+                write_chunks(f, dixel.data['file'])
+            # The id comes from the header, since archive members only
+            # have a file name
+            d = update_file(make_predixel(f.name, os.stat(f.name)))
+            if not d:
+                raise ValueError("{0} isn't a DICOM file".format(dixel))
+        except Exception:
+            os.remove(f.name)
+            raise
+
+        full_path = os.path.join(self.loc, d.id[0:2], d.id[2:4], d.id)
+        with self.put_lock:
+            self.unsynced.append((f.name, full_path, d))
+            if len(self.unsynced) >= FSYNC_BATCH:
+                self.flush(save=False)
+        return full_path
+
+    def flush(self, save=True):
+        # fsync the pending temp files, rename them into place, fsync their
+        # directories, and add them to the cached inventory.  With save, the
+        # cache is saved too, so that the next run sees the new files; puts
+        # leave that to the flush at the end of copy_worklist.
+        with self.put_lock:
+            pending, self.unsynced = self.unsynced, []
+            if pending:
+                self.write_pending(pending)
+            if save and self.appended:
+                self.save_cache()
+                self.appended = False
+
+    def write_pending(self, pending):
+        # Called by flush() with the put lock held
+        for tmp_path, _, _ in pending:
+            fd = os.open(tmp_path, os.O_RDONLY)
             try:
-                meta['Dimensions']=[tags[0x0028, 0x0010].value, tags[0x0028, 0x0011].value]
-            except KeyError:
-                pass
-
-            meta['id'] = DixelTools.orthanc_id(meta['PatientID'],
-                                       meta['StudyInstanceUID'],
-                                       meta['SeriesInstanceUID'],
-                                       meta['SOPInstanceUID'])
-
-            # Keep other meta data, such as file path
-            meta.update(dixel.meta)
-
-            self.logger.debug('{0} ({1}) id: {2}'.format(dixel.meta['fn'], magic_type, meta['id']))
-
-            return Dixel(meta['id'], meta=meta, level=DicomLevel.INSTANCES)
-
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        dirs = set()
+        for tmp_path, full_path, d in pending:
+            path = os.path.dirname(full_path)
+            if path not in dirs and not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+            os.rename(tmp_path, full_path)
+            dirs.add(path)
+            d.meta.update(make_predixel(full_path, os.stat(full_path)).meta)
+
+        for path in dirs:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        self.append_inventory([d for _, _, d in pending])
+        self.appended = True
+        self.logger.debug('Wrote {0} files'.format(len(pending)))
+
+    def append_inventory(self, dixels):
+        # Add newly written files to whatever is cached, so inventory doesn't
+        # need a rescan.  A pickled cache is updated in memory only, and is
+        # written out with the next save_cache.
+        inventory = self.cache.get('inventory')
+        if not inventory:
+            return
+        inventory.update(dixels)
+
+        file_index = self.cache.get('file_index')
+        preinventory = self.cache.get('preinventory')
+        for d in dixels:
+            if file_index is not None:
+                file_index[d.meta['full_path']] = (d.meta['stat'], d)
+            if preinventory is not None:
+                preinventory.add(make_predixel(d.meta['full_path'], os.stat(d.meta['full_path'])))
+
+        self.cache['compact_inventory'] = None
+        self.cache['tree'] = None
 
     def copy(self, dixel, dest):
         # May have various tasks to do, like anonymize or compress
@@ -113,32 +562,41 @@ class FileStorage(DixelStorage):
             #   2. Is value/representation
             #   3. That each dimension is divisible by 8 (square doesn't matter?)
             #   4. Throw out SR and Secondary just in case (shouldn't reach that condition)
-            if dest.prefer_compressed and \
+            compress = dest.prefer_compressed and \
                     dixel.meta['HasPixels'] and \
                     int(dixel.meta['Dimensions'][0]) % 8 == 0 and \
                     int(dixel.meta['Dimensions'][1]) % 8 == 0 and \
                     "VR" in str(dixel.meta['TransferSyntaxUID']) and \
                     "SR" not in str(dixel.meta['MediaStorage']) and \
-                    "Secondary" not in str(dixel.meta['MediaStorage']):
+                    "Secondary" not in str(dixel.meta['MediaStorage'])
 
-                self.logger.debug('Compressing {}'.format(dixel.meta['fn']))
+            # Wait until this file fits under the shared in-flight limit
+            size = os.path.getsize(dixel.meta['full_path'])
+            with IN_FLIGHT_BYTES.reserve(size):
 
-                # Compress w gdcm
-                full_pathz = "/tmp/{}.compressed".format(dixel.meta['fn'])
-                subprocess.call(['gdcmconv', '-U', '--j2k', dixel.meta['full_path'], full_pathz])
-                with open(full_pathz, "rb") as f:
-                    dixel.data['file'] = f.read()
-                os.remove(full_pathz)
+                if compress:
 
-            else:
+                    self.logger.debug('Compressing {}'.format(dixel.meta['fn']))
 
-                self.logger.debug('NOT compressing {}'.format(dixel.meta['fn']))
+                    try:
+                        dixel.data['file'] = self.compressor.compress(dixel.meta['full_path'])
+                    except Exception as e:
+                        self.logger.warning('Could not compress {0}, sending uncompressed: {1}'.format(
+                            dixel.meta['fn'], e))
 
-                with open(dixel.meta['full_path'], "rb") as f:
-                    dixel.data['file'] = f.read()
+                if not dixel.data.get('file'):
 
-            dest.put(dixel)
-            dixel.data['file'] = None  # Clear data
+                    self.logger.debug('NOT compressing {}'.format(dixel.meta['fn']))
+
+                    # Stream the body from disk rather than reading it in
+                    dixel.data['file'] = open(dixel.meta['full_path'], "rb")
+
+                try:
+                    dest.put(dixel)
+                finally:
+                    if hasattr(dixel.data['file'], 'close'):
+                        dixel.data['file'].close()
+                    dixel.data['file'] = None  # Clear data
 
         else:
             raise NotImplementedError(
@@ -147,3 +605,123 @@ class FileStorage(DixelStorage):
                     dixel.level,
                     dest.__class__.__name__))
 
+
+def read_header(full_path):
+    # Parse a DICOM file up to, but not including, its pixel data.  Checks the
+    # 128-byte preamble + "DICM" magic itself instead of asking libmagic, and
+    # skips over any other large elements.  Returns (tags, has_pixels), or
+    # (None, False) for non-DICOM files.
+
+    with open(full_path, 'rb') as f:
+
+        preamble = f.read(132)
+        if preamble[128:132] != 'DICM':
+            return None, False
+        f.seek(0)
+
+        tags = dicom.read_file(f, defer_size=HEADER_DEFER_SIZE, stop_before_pixels=True)
+
+        # The parser leaves the file positioned on the element it stopped at
+        has_pixels = f.read(4) in PIXEL_DATA_TAGS
+
+    if tags.file_meta.TransferSyntaxUID == DEFLATED_TRANSFER_SYNTAX:
+        # Parsed from an inflated copy, so the file position is meaningless
+        has_pixels = 'PixelData' in dicom.read_file(full_path)
+
+    return tags, has_pixels
+
+
+def simplify_dataset(ds):
+    # Keyword: value dict like Orthanc's "?simplify".  Binary, private, and
+    # deferred (too big to have been read) elements are left out.
+
+    def simplify_value(v):
+        return v if isinstance(v, basestring) else str(v)
+
+    res = {}
+    for tag in sorted(ds.keys()):
+        raw = dict.__getitem__(ds, tag)
+        if isinstance(raw, tuple) and raw.value is None:
+            continue
+        elem = ds[tag]
+        key = dicom.datadict.keyword_for_tag(tag)
+        if not key or elem.VR in ('OB', 'OW', 'OF', 'UN'):
+            continue
+        if elem.VR == 'SQ':
+            res[key] = [simplify_dataset(item) for item in elem.value]
+        elif elem.VM > 1:
+            res[key] = '\\'.join(simplify_value(v) for v in elem.value)
+        else:
+            res[key] = simplify_value(elem.value)
+    return res
+
+
+def make_predixel(full_path, st):
+    path, fn = os.path.split(full_path)
+    meta = {'fn': fn,
+            'path': path,
+            'full_path': full_path,
+            'stat': (st.st_size, st.st_mtime, st.st_ino)}
+    return Dixel(full_path, meta=meta)
+
+
+def write_chunks(f, data, chunk_size=WRITE_CHUNK):
+    if isinstance(data, (bytes, bytearray)):
+        f.write(data)
+    elif hasattr(data, 'read'):
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+    else:
+        for chunk in data:
+            f.write(chunk)
+
+
+# Module level so that it can be pickled out to pool workers
+def update_file(dixel):
+
+    tags, has_pixels = read_header(dixel.meta['full_path'])
+    if tags is not None:
+
+        meta = { 'PatientID'         : tags[0x0010, 0x0020].value,
+                 'StudyInstanceUID'  : tags[0x0020, 0x000d].value,
+                 'SeriesInstanceUID' : tags[0x0020, 0x000e].value,
+                 'SOPInstanceUID'    : tags[0x0008, 0x0018].value,
+                 'TransferSyntaxUID' : tags.file_meta.TransferSyntaxUID,
+                 'MediaStorage'      : tags.file_meta.MediaStorageSOPClassUID,
+                 'AccessionNumber'   : tags[0x0008, 0x0050].value,
+                 'HasPixels'         : has_pixels
+                }
+
+        try:
+            meta['Dimensions']=[tags[0x0028, 0x0010].value, tags[0x0028, 0x0011].value]
+        except KeyError:
+            pass
+
+        meta['id'] = DixelTools.orthanc_id(meta['PatientID'],
+                                   meta['StudyInstanceUID'],
+                                   meta['SeriesInstanceUID'],
+                                   meta['SOPInstanceUID'])
+
+        # Keep other meta data, such as file path
+        meta.update(dixel.meta)
+
+        logging.debug('{0} id: {1}'.format(dixel.meta['fn'], meta['id']))
+
+        return Dixel(meta['id'], meta=meta, level=DicomLevel.INSTANCES)
+
+
+def file_checksum(full_path, blocksize=1024 * 1024):
+    # CRC is plenty to tell apart two files that are already known to share an id
+    crc = 0
+    with open(full_path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+
+def parse_file(predixel):
+    # Keep the predixel with its result so non-DICOM files can be indexed too
+    return predixel, update_file(predixel)
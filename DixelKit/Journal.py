@@ -0,0 +1,75 @@
+import os
+import pickle
+import logging
+
+# fsync after this many records; a crash loses at most these, which are redone
+SYNC_EVERY = 100
+
+
+class Journal(object):
+    # Append-only record of finished worklist operations, so a restarted
+    # copy_worklist or update_worklist can skip what's already done.
+    #
+    # Each record is a pickled (op, id, result) tuple.  Records are read back
+    # into a dict when the journal is opened, so checking an item is a single
+    # lookup and a restart only pays for the remaining work.  A torn record at
+    # the end of the file (ie, from a killed process) is dropped.
+    #
+    # Use one journal per job, ie, per (source, destination) pair.
+
+    def __init__(self, fn, sync_every=SYNC_EVERY):
+        self.logger = logging.getLogger()
+        self.fn = fn
+        self.sync_every = sync_every
+        self.entries = {}   # op: {id: result}
+        self.unsynced = 0
+
+        good = 0
+        if os.path.exists(fn):
+            with open(fn, 'rb') as f:
+                while True:
+                    try:
+                        op, id, result = pickle.load(f)
+                    except EOFError:
+                        break
+                    except Exception:
+                        self.logger.warning('Dropping torn record at end of {0}'.format(fn))
+                        break
+                    self.entries.setdefault(op, {})[id] = result
+                    good = f.tell()
+
+        self.f = open(fn, 'ab')
+        self.f.truncate(good)
+        self.logger.debug('Journal {0} has {1} finished items'.format(fn, len(self)))
+
+    def __len__(self):
+        return sum(len(v) for v in self.entries.values())
+
+    def done(self, op):
+        # {id: result} for everything op has finished
+        return self.entries.setdefault(op, {})
+
+    def record(self, op, dixel, result=None):
+        id = getattr(dixel, 'id', dixel)
+        pickle.dump((op, id, result), self.f, 2)
+        self.f.flush()
+        self.done(op)[id] = result
+        self.unsynced = self.unsynced + 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,8 +1,8 @@
 import requests
 from pprint import pformat
-from Dixel import *
-from DixelStorage import *
-import DixelTools
+from .Dixel import *
+from .DixelStorage import *
+from . import DixelTools
 
 
 class Montage(DixelStorage):
@@ -33,22 +33,32 @@ class Montage(DixelStorage):
         #     # Already looked this exam up
         #     return dixel
 
-        qdict = kwargs.get('qdict', {})
+        qdict = self.make_qdict(dixel, time_delta, **kwargs)
+        r = self.query(qdict)
+        return self.update_from_results(dixel, r, **kwargs)
+
+    def make_qdict(self, dixel, time_delta=0, **kwargs):
+
+        # Copied, so concurrent lookups can share a template
+        qdict = dict(kwargs.get('qdict', {}))
 
         PatientID = dixel.meta['PatientID']
         earliest, latest = DixelTools.daterange(dixel.meta['ReferenceTime'], time_delta)
-        AccessionNumber = None
 
         q = PatientID
         if dixel.meta.get("AccessionNumber"):
-            AccessionNumber = dixel.meta["AccessionNumber"]
-            q = q + "+" + AccessionNumber
+            q = q + "+" + dixel.meta["AccessionNumber"]
 
         qdict["q"] = q
         qdict["start_date"] = earliest
         qdict["end_date"] = latest
 
-        r = self.query(qdict)
+        return qdict
+
+    # Fill in a dixel from the results of its query
+    def update_from_results(self, dixel, r, **kwargs):
+
+        AccessionNumber = dixel.meta.get("AccessionNumber")
 
         # Got some hits
         if r:
@@ -1,11 +1,54 @@
+import os
+import tempfile
+import zipfile
+from datetime import datetime, timedelta
 import requests
 from requests import ConnectionError
+from requests.adapters import HTTPAdapter
 from hashlib import sha1
 from pprint import pformat
-from Dixel import *
-from DixelStorage import *
-import DixelTools
-from Splunk import Splunk
+from .Dixel import *
+from .DixelStorage import *
+from . import DixelTools
+from .CompactInventory import CompactInventory
+from .DixelTree import DixelTree
+from .Splunk import Splunk
+
+
+# Keep-alive connections per host, enough for concurrent worklists
+CONNECTION_POOL_SIZE = 32
+
+# Changes per request when refreshing an inventory from /changes
+CHANGES_PAGE = 1000
+
+# Ids per request when listing instances, series, or studies
+LIST_PAGE = 10000
+
+# Resources per request when listing them expanded
+EXPAND_PAGE = 1000
+
+# Bytes per read when streaming instances and archives down
+DOWNLOAD_CHUNK = 1024 * 1024
+
+# Largest batch of changes patched into a cached tree, rather than rebuilding it
+TREE_REFRESH_MAX = 10000
+
+# Resources per /tools/bulk-delete request
+DELETE_BATCH = 1000
+
+# Simplified tags kept in memory per server, and worklist items per prefetch
+TAG_CACHE_SIZE = 10000
+UPDATE_BATCH = 1000
+
+# Smallest worklist worth sorting by series, to prefetch tags
+PREFETCH_MIN = 100
+
+# Only prefetch a series when a batch wants at least 1/PREFETCH_SHARE of it
+PREFETCH_SHARE = 4
+
+# Days of study dates per C-FIND when batching proxy lookups by StudyDate;
+# these are series level queries, so every series in the range comes back
+FIND_DAYS = 1
 
 
 class Orthanc(DixelStorage):
@@ -18,17 +61,27 @@ class Orthanc(DixelStorage):
                  cache_policy=CachePolicy.NONE,
                  prefer_compressed=False,
                  peer_name=None,
+                 storage=None,
+                 cache_backend="pickle",
                  **kwargs):
         self.session = requests.session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=CONNECTION_POOL_SIZE))
         if user and password:
             self.session.auth = (user, password)
         self.url = "http://{host}:{port}".format(host=host, port=port)
         self.prefer_compressed = prefer_compressed
         self.peer_name = peer_name
+        # FileStorage on this Orthanc's StorageDirectory when running on the
+        # same host, so instance metadata can be read from disk
+        self.storage = storage
+        self.attachments = {}   # instance id: file_uuid, for the worklist in progress
+        self.tag_cache = DixelTools.LRU(TAG_CACHE_SIZE)  # (level, id): simplified tags
         cache_pik = "{0}.pik".format(
                 sha1("{0}:{1}@{2}".format(
-                user, password, self.url)).hexdigest()[0:8])
-        super(Orthanc, self).__init__(cache_pik=cache_pik, cache_policy=cache_policy)
+                user, password, self.url).encode("utf-8")).hexdigest()[0:8])
+        super(Orthanc, self).__init__(cache_pik=cache_pik,
+                                      cache_policy=cache_policy,
+                                      cache_backend=cache_backend)
 
     def statistics(self):
         url = "{0}/statistics".format(self.url)
@@ -36,12 +89,57 @@ class Orthanc(DixelStorage):
         return r.json()
 
     def get(self, dixel, **kwargs):
-        raise NotImplementedError
+        # Returns a copy of the dixel whose data['file'] streams the instance
+        # file, or the study or series ZIP archive, DOWNLOAD_CHUNK at a time.
+        # The response is closed once the chunks have been read.
+        if dixel.level == DicomLevel.INSTANCES:
+            url = "{}/instances/{}/file".format(self.url, dixel.id)
+        else:
+            url = "{}/{}/{}/archive".format(self.url, str(dixel.level), dixel.id)
+        r = self.session.get(url, stream=True)
+        r.raise_for_status()
+
+        def chunks():
+            try:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                    yield chunk
+            finally:
+                r.close()
+
+        return Dixel(dixel.id, meta=dixel.meta.copy(), data={'file': chunks()}, level=dixel.level)
+
+    def get_archive(self, dixel, dest):
+        # Download a study or series archive next to dest's files, then put
+        # each member into dest.  Concurrent copies keep downloading while
+        # this one unpacks.  Returns the number of instances put.
+        d = Orthanc.get(self, dixel)
+        # Named like dest's own temp files, so it's never inventoried
+        f = tempfile.NamedTemporaryFile(prefix=TMP_PREFIX, suffix='.zip', dir=dest.loc, delete=False)
+        try:
+            with f:
+                for chunk in d.data['file']:
+                    f.write(chunk)
+            count = 0
+            with zipfile.ZipFile(f.name) as archive:
+                for info in archive.infolist():
+                    if info.filename.endswith('/'):
+                        continue
+                    member = archive.open(info)
+                    try:
+                        dest.put(Dixel(info.filename, meta={'fn': info.filename},
+                                       data={'file': member}))
+                    finally:
+                        member.close()
+                    count = count + 1
+            return count
+        finally:
+            os.remove(f.name)
 
     def put(self, dixel):
         if dixel.level != DicomLevel.INSTANCES:
             raise NotImplementedError("Orthanc can only put dixel instances")
 
+        # data['file'] may be a string or an open file, which requests streams
         headers = {'content-type': 'application/dicom'}
         url = "{0}/instances/".format(self.url)
         r = self.session.post(url, data=dixel.data['file'], headers=headers)
@@ -64,33 +162,336 @@ class Orthanc(DixelStorage):
 
         self.logger.debug(pformat(r.json()))
 
+    def delete_worklist(self, worklist, rollup=DicomLevel.PATIENTS, workers=8):
+        # Rolls the worklist up to whole patients (or studies, with rollup)
+        # wherever it covers them, then deletes DELETE_BATCH resources per
+        # /tools/bulk-delete request, or concurrently one at a time where
+        # Orthanc doesn't have it.  Returns a summary rather than logging
+        # each response:
+        #   {'resources': n, 'instances': n, 'errors': {id: error}}
+
+        if rollup:
+            worklist = self.rollup(worklist, rollup)
+        worklist = list(worklist)
+
+        summary = {'resources': 0, 'instances': 0, 'errors': {}}
+
+        def deleted(dixels):
+            summary['resources'] += len(dixels)
+            summary['instances'] += sum(d.meta.get('InstanceCount', 1) for d in dixels)
+
+        url = "{0}/tools/bulk-delete".format(self.url)
+        remaining = []
+        for i, chunk in enumerate(DixelTools.chunks(worklist, DELETE_BATCH)):
+            r = self.session.post(url, json={'Resources': [d.id for d in chunk]})
+            if r.status_code == 200:
+                deleted(chunk)
+            elif i == 0 and r.status_code in (404, 405):
+                # No bulk delete on this server
+                remaining = worklist
+                break
+            else:
+                remaining.extend(chunk)
+
+        def delete(dixel):
+            url = "{}/{}/{}".format(self.url, str(dixel.level), dixel.id)
+            r = self.session.delete(url)
+            r.raise_for_status()
+
+        for dixel, _, e in DixelTools.threaded_map(delete, remaining, workers):
+            if e:
+                summary['errors'][dixel.id] = e
+            else:
+                deleted([dixel])
+
+        self.logger.info('Deleted {resources} resources ({instances} instances), {0} errors'.format(
+            len(summary['errors']), **summary))
+        return summary
+
     def update(self, dixel, **kwargs):
 
-        meta = dixel.meta.copy()
+        if self.storage and dixel.level == DicomLevel.INSTANCES:
+            d = self.update_from_storage(dixel)
+            if d:
+                return d
 
-        if dixel.level != "series":
-            url = "{}/{}/{}/tags?simplify".format(self.url, str(dixel.level), dixel.id)
-        else:
-            url = "{}/{}/{}/shared-tags?simplify".format(self.url, str(dixel.level), dixel.id)
-	    
-        r = self.session.get(url)
+        meta = dixel.meta.copy()
+        meta.update(self.get_tags(dixel))
 
-        tags = r.json()
-        tags = DixelTools.simplify_tags(tags)
+        if dixel.level == DicomLevel.INSTANCES:
+            meta.update(self.get_metadata(dixel))
 
-        meta.update(tags)
+        return Dixel(dixel.id, meta=meta, level=dixel.level)
 
-        if dixel.level == "instance":
-            url = "{}/{}/{}/metadata/TransferSyntaxUID".format(self.url, str(dixel.level), dixel.id)
+    def get_tags(self, dixel):
+        # Simplified tags, from the LRU when this resource was seen recently
+        key = (str(dixel.level), dixel.id)
+        tags = self.tag_cache.get(key)
+        if tags is None:
+            if dixel.level != DicomLevel.SERIES:
+                url = "{}/{}/{}/tags?simplify".format(self.url, str(dixel.level), dixel.id)
+            else:
+                url = "{}/{}/{}/shared-tags?simplify".format(self.url, str(dixel.level), dixel.id)
             r = self.session.get(url)
-            meta['TransferSyntaxUID'] = r.json()
-
-            url = "{}/{}/{}/metadata/SopClassUid".format(self.url, str(dixel.level), dixel.id)
+            tags = DixelTools.simplify_tags(r.json())
+            self.tag_cache.put(key, tags)
+        return tags
+
+    def get_metadata(self, dixel):
+        # TransferSyntaxUID and SOPClassUID in one request where Orthanc
+        # can expand metadata, otherwise one request each
+        key = ('metadata', dixel.id)
+        meta = self.tag_cache.get(key)
+        if meta is not None:
+            return meta
+
+        url = "{}/{}/{}/metadata".format(self.url, str(dixel.level), dixel.id)
+        r = self.session.get(url, params={'expand': ''})
+        values = r.json() if r.status_code == 200 else None
+        if not isinstance(values, dict):
+            values = {}
+            for name in ['TransferSyntax', 'SopClassUid']:
+                r = self.session.get("{}/{}".format(url, name))
+                if r.status_code == 200:
+                    values[name] = r.text
+
+        sop = values.get('SopClassUid')
+        meta = {'TransferSyntaxUID': values.get('TransferSyntax', values.get('TransferSyntaxUID')),
+                'SOPClassUID': DixelTools.DICOM_SOPS.get(sop, sop)}  # Text or return val
+        self.tag_cache.put(key, meta)
+        return meta
+
+    def prefetch_tags(self, worklist, workers=1):
+        # Fill the tag cache with one instances-tags request per series for
+        # instances in the (cached) tree, instead of one request per instance.
+        # Only the worklist's own instances are cached, and only for series
+        # where it wants at least 2 instances and 1/PREFETCH_SHARE of them,
+        # so a scattered worklist costs no more than fetching each instance.
+        tree = self.cache.get('tree')
+        if not tree:
+            return
+        wanted = {}     # series id: set of instance ids
+        for dixel in worklist:
+            node = tree.nodes.get(dixel.id)
+            if node is not None and node.level == DicomLevel.INSTANCES and \
+                    self.tag_cache.get((str(dixel.level), dixel.id)) is None:
+                wanted.setdefault(node.parent.id, set()).add(dixel.id)
+        series = [id for id, ids in wanted.items()
+                  if len(ids) >= 2 and
+                  len(ids) * PREFETCH_SHARE >= tree.nodes[id].meta['InstanceCount']]
+
+        def fetch(id):
+            url = "{}/series/{}/instances-tags?simplify".format(self.url, id)
             r = self.session.get(url)
-            meta['SOPClassUID'] = DixelTools.DICOM_SOPS.get(r.json(), r.json())  # Text or return val
+            r.raise_for_status()
+            for instance, tags in r.json().items():
+                if instance in wanted[id]:
+                    self.tag_cache.put((str(DicomLevel.INSTANCES), instance),
+                                       DixelTools.simplify_tags(tags))
+
+        for id, _, e in DixelTools.threaded_map(fetch, series, workers):
+            if e:
+                self.logger.warning('Could not prefetch tags for series {0}: {1}'.format(id, e))
+
+
+    def update_from_storage(self, dixel):
+        # Co-located fast path, parse the attachment directly instead of
+        # making three REST calls.  Returns None if it isn't available.
+
+        file_uuid = self.attachments.pop(dixel.id, None) or self.attachment_uuid(dixel)
+        full_path = file_uuid and self.storage.orthanc_path(file_uuid)
+        if not full_path:
+            return
+
+        tags = self.storage.read_tags(full_path)
+        if not tags:
+            return
+
+        meta = dixel.meta.copy()
+        meta.update(DixelTools.simplify_tags(tags))
+        meta['SOPClassUID'] = DixelTools.DICOM_SOPS.get(tags.get('SOPClassUID'), tags.get('SOPClassUID'))
 
         return Dixel(dixel.id, meta=meta, level=dixel.level)
 
+    def attachment_uuid(self, dixel):
+        # One request, for instances that the batch lookup in Orthanc's index
+        # didn't find (ie, while Orthanc holds its exclusive lock on it).
+        # Compressed attachments don't parse, so they fall back to REST.
+        url = "{}/instances/{}/attachments/dicom/uuid".format(self.url, dixel.id)
+        r = self.session.get(url)
+        if r.status_code == 200:
+            return r.text.strip().strip('"')
+
+    def load_attachments(self, dixels):
+        # Add the attachment uuids for dixels to self.attachments from the
+        # co-located Orthanc's index.  False if the index can't be read.
+        found = self.storage.orthanc_attachments(
+            [d.id for d in dixels if d.level == DicomLevel.INSTANCES])
+        if found is None:
+            return False
+        self.attachments.update(found)
+        return True
+
+    def attached(self, worklist):
+        # The worklist, with attachment uuids looked up in one pass if it's
+        # in hand, or UPDATE_BATCH at a time as a stream goes by, so only
+        # the worklist's own instances are ever loaded.
+        #
+        # A running Orthanc holds an exclusive lock on its index.  Then the
+        # first lookup fails and logs a warning, the rest of the worklist
+        # doesn't try again, and each instance asks the REST api for its
+        # uuid instead (see attachment_uuid).
+        if not self.storage:
+            return worklist
+        if isinstance(worklist, (set, frozenset, list, tuple)):
+            self.load_attachments(worklist)
+            return worklist
+        return self.iter_attached(worklist)
+
+    def iter_attached(self, worklist):
+        items = iter(worklist)
+        for chunk in DixelTools.chunks(items, UPDATE_BATCH):
+            readable = self.load_attachments(chunk)
+            for dixel in chunk:
+                yield dixel
+            if not readable:
+                for dixel in items:
+                    yield dixel
+                return
+
+    def update_worklist(self, worklist, workers=1, **kwargs):
+        # Updates run UPDATE_BATCH at a time, so that tags prefetched by
+        # series are still in the tag cache when each instance asks for them
+        worklist = self.attached(worklist)
+        try:
+            res = set()
+            if not self.storage:
+                worklist = self.prefetched(worklist, workers)
+            for chunk in DixelTools.chunks(worklist, UPDATE_BATCH):
+                res.update(super(Orthanc, self).update_worklist(chunk, workers=workers, **kwargs))
+            return res
+        finally:
+            self.attachments = {}
+
+    def copy_inventory(self, dest, lazy=False, batch_size=None, rollup=None, reconcile=False,
+                       **kwargs):
+        # A lazy, rolled up copy between Orthancs diffs the two trees by
+        # digest, so whole missing studies or series are found without a
+        # per-instance diff.  With reconcile, the cached trees are used
+        # instead of fresh listings.
+        if lazy and rollup and type(dest) == Orthanc and type(self) == Orthanc:
+            if reconcile:
+                worklist = self.reconcile(dest, rollup)
+            else:
+                worklist = self.initialize_tree().difference(dest.initialize_tree(), rollup)
+            try:
+                return self.copy_batches(dest, worklist, batch_size or 1000, **kwargs)
+            finally:
+                dest.cache['tree'] = None
+        return super(Orthanc, self).copy_inventory(dest, lazy, batch_size=batch_size,
+                                                   rollup=rollup, reconcile=reconcile, **kwargs)
+
+    def copy_worklist(self, dest, worklist, lazy=False, batch_size=None, rollup=None, **kwargs):
+        # Orthanc to Orthanc copies can be sent batch_size resources per
+        # store request, optionally rolled up to whole series or studies
+        # first.  Proxies have to retrieve each dixel, so they don't batch.
+        if (batch_size or rollup) and type(dest) == Orthanc and type(self) == Orthanc:
+            if lazy and isinstance(worklist, CompactInventory):
+                worklist = worklist - dest.compact_inventory
+            elif lazy:
+                worklist = set(worklist) - dest.inventory
+            return self.copy_batches(dest, worklist, batch_size or 1000, rollup, **kwargs)
+
+        if type(dest) == Splunk and not self.storage:
+            # Each copy is an update, so diff first and then prefetch tags
+            # for whatever is left
+            if lazy and isinstance(worklist, (set, frozenset)):
+                worklist = worklist - dest.inventory
+            elif lazy:
+                inventory = dest.inventory
+                worklist = (dixel for dixel in worklist if dixel not in inventory)
+            return super(Orthanc, self).copy_worklist(
+                dest, self.prefetched(worklist, kwargs.get('workers', 1)), **kwargs)
+
+        worklist = self.attached(worklist)
+        try:
+            return super(Orthanc, self).copy_worklist(dest, worklist, lazy, **kwargs)
+        finally:
+            self.attachments = {}
+
+    def prefetched(self, worklist, workers=1):
+        # Pass the worklist through, prefetching tags UPDATE_BATCH at a time.
+        # Only instances in an already cached tree are prefetched, building
+        # one would list every study and series on the server.  Worklists in
+        # hand are ordered by series first, so that each batch covers whole
+        # series, unless they are too small to bother.
+        if not self.cache:
+            self.load_cache()
+        tree = self.cache.get('tree')
+        if not tree:
+            for dixel in worklist:
+                yield dixel
+            return
+
+        if isinstance(worklist, (set, frozenset, list, tuple)):
+            if len(worklist) < PREFETCH_MIN:
+                for dixel in worklist:
+                    yield dixel
+                return
+            nodes = tree.nodes
+
+            def series(dixel):
+                node = nodes.get(dixel.id)
+                return node.parent.id if node is not None and node.parent is not None else ''
+
+            worklist = sorted(worklist, key=series)
+
+        for chunk in DixelTools.chunks(worklist, UPDATE_BATCH):
+            self.prefetch_tags(chunk, workers)
+            for dixel in chunk:
+                yield dixel
+
+    def copy_batches(self, dest, worklist, batch_size, rollup=None, workers=1, results=None,
+                     journal=None, **kwargs):
+        # Returns the number of instances sent, like copy_worklist.  The
+        # journal records the (possibly rolled up) ids in each stored chunk.
+
+        if rollup:
+            worklist = self.rollup(worklist, rollup)
+
+        if journal is not None:
+            finished = journal.done('copy')
+            worklist = [d for d in worklist if d.id not in finished]
+
+        url = "{0}/peers/{1}/store".format(self.url, dest.peer_name)
+
+        def send(chunk):
+            r = self.session.post(url, json=[d.id for d in chunk])
+            if r.status_code != 200:
+                raise Exception("Could not store {0} items on {1} ({2})".format(
+                    len(chunk), dest.peer_name, r.status_code))
+
+        count = 0
+        sent = DixelTools.threaded_map(send, DixelTools.chunks(worklist, batch_size), workers)
+        for chunk, _, e in sent:
+            if e:
+                self.logger.error(e)
+            else:
+                count = count + sum(d.meta.get('InstanceCount', 1) for d in chunk)
+                if journal is not None:
+                    for d in chunk:
+                        journal.record('copy', d)
+            if results is not None:
+                for d in chunk:
+                    results[d] = e
+
+        return count
+
+    def rollup(self, worklist, level=DicomLevel.SERIES):
+        # Replace instances with their series, or study when level is
+        # STUDIES, wherever the worklist holds every child.  Uses a fresh
+        # tree, so that a rolled up resource never covers anything new.
+        return self.initialize_tree().rollup(worklist, level)
 
     def copy(self, dixel, dest):
         # May have various tasks to do, like anonymize or compress
@@ -104,6 +505,14 @@ class Orthanc(DixelStorage):
             dixel = self.update(dixel)  # Add available data and meta data, parse
             dest.put(dixel)
 
+        elif hasattr(dest, 'loc'):
+            # Files under a directory, ie, a FileStorage
+            if dixel.level == DicomLevel.INSTANCES:
+                # Not OrthancProxy.get, which retrieves from the PACS
+                dest.put(Orthanc.get(self, dixel))
+            else:
+                self.get_archive(dixel, dest)
+
         else:
             raise NotImplementedError(
                 "{} doesn't know how to put dixel {} into {}".format(
@@ -112,15 +521,151 @@ class Orthanc(DixelStorage):
                     dest.__class__.__name__))
 
     def initialize_inventory(self):
-        res = set()
-        r = self.session.get("{0}/instances".format(self.url)).json()
-        for item in r:
-            res.add(Dixel(id=item, level=DicomLevel.INSTANCES))
+        # Note where the changes feed is first, so refresh_inventory can't
+        # miss anything that lands while the ids are being listed
+        self.cache['changes_seq'] = self.changes_seq()
+
+        res = set(self.iter_inventory())
 
         # self.logger.debug(res)
 
         return res
 
+    def iter_ids(self, level=DicomLevel.INSTANCES, page_size=None):
+        # Page through the ids at a level with since/limit, so no single
+        # response holds the whole server
+        return self.iter_listing(level, page_size or LIST_PAGE)
+
+    def iter_listing(self, level=DicomLevel.INSTANCES, page_size=LIST_PAGE, expand=False):
+        # Ids, or with expand the resources themselves, page_size at a time
+        url = "{0}/{1}".format(self.url, level)
+        params = {'expand': ''} if expand else {}
+        since = 0
+        while True:
+            params.update(since=since, limit=page_size)
+            r = self.session.get(url, params=params)
+            r.raise_for_status()
+            items = r.json()
+            for item in items:
+                yield item
+            if len(items) < page_size:
+                return
+            since = since + len(items)
+
+    def iter_inventory(self, level=DicomLevel.INSTANCES, page_size=None):
+        # Stream dixels for every instance (or series, or study) without
+        # building or caching the whole inventory
+        for id in self.iter_ids(level, page_size):
+            yield Dixel(id, level=level)
+
+    def changes_seq(self):
+        r = self.session.get("{0}/changes?last".format(self.url)).json()
+        return r['Last']
+
+    def refresh_inventory(self):
+        # Apply the NewInstance and Deleted changes since the inventory was
+        # cached, CHANGES_PAGE at a time.  Falls back to a full listing if
+        # there is no cached inventory, or if Orthanc has pruned (or reset)
+        # its changes since then.
+
+        if not self.cache:
+            self.load_cache()
+
+        seq = self.cache.get('changes_seq')
+        inventory = self.cache.get('inventory')
+        if seq is None or inventory is None:
+            self.cache['inventory'] = None
+            return self.inventory
+
+        added = removed = 0
+        applied = []    # (ChangeType, id), in order, for the tree
+        while True:
+            r = self.session.get("{0}/changes".format(self.url),
+                                 params={'since': seq, 'limit': CHANGES_PAGE}).json()
+            changes = r['Changes']
+            if (changes and changes[0]['Seq'] > seq + 1) or r['Last'] < seq:
+                self.logger.info('Changes since {0} are gone, reloading inventory'.format(seq))
+                self.cache['inventory'] = None
+                return self.inventory
+
+            for change in changes:
+                if change['ResourceType'] != 'Instance':
+                    continue
+                if change['ChangeType'] == 'NewInstance':
+                    inventory.add(Dixel(change['ID'], level=DicomLevel.INSTANCES))
+                    added = added + 1
+                elif change['ChangeType'] == 'Deleted':
+                    inventory.discard(Dixel(change['ID'], level=DicomLevel.INSTANCES))
+                    removed = removed + 1
+                else:
+                    continue
+                applied.append((change['ChangeType'], change['ID']))
+
+            seq = r['Last']
+            if r['Done']:
+                break
+
+        self.logger.debug('Refreshed {0} to change {1}: {2} new, {3} deleted'.format(
+            self.url, seq, added, removed))
+
+        self.cache['changes_seq'] = seq
+        # Derived from the old inventory; a small change is patched into
+        # the tree, so its digests stay current for reconcile
+        self.cache['compact_inventory'] = None
+        tree = self.cache.get('tree')
+        if tree and len(applied) <= TREE_REFRESH_MAX:
+            self.refresh_tree(tree, applied)
+            self.cache['tree'] = tree
+        else:
+            self.cache['tree'] = None
+        self.save_cache()
+
+        return inventory
+
+    def refresh_tree(self, tree, changes):
+        # Apply (ChangeType, id) instance changes, looking up the parents of
+        # new instances unless they're already in the tree
+        parents = {}    # series or study id: parent id
+
+        def parent(level, id, key):
+            if id in tree.nodes:
+                return tree.nodes[id].parent.id
+            if id not in parents:
+                r = self.session.get("{0}/{1}/{2}".format(self.url, level, id))
+                r.raise_for_status()
+                parents[id] = r.json()[key]
+            return parents[id]
+
+        for change, id in changes:
+            if change == 'Deleted':
+                tree.remove(id)
+                continue
+            r = self.session.get("{0}/instances/{1}".format(self.url, id))
+            if r.status_code != 200:
+                # Already gone again
+                continue
+            series = r.json()['ParentSeries']
+            study = parent('series', series, 'ParentStudy')
+            patient = parent('studies', study, 'ParentPatient')
+            tree.add(Dixel(id, level=DicomLevel.INSTANCES), patient, study, series)
+
+    def initialize_tree(self):
+        # From the expanded study and series listings, without a request
+        # per instance.  Orthanc doesn't list sizes, so those are left at 0.
+        tree = DixelTree()
+        studies = dict((item['ID'], item['ParentPatient']) for item in
+                       self.iter_listing(DicomLevel.STUDIES, EXPAND_PAGE, expand=True))
+        for item in self.iter_listing(DicomLevel.SERIES, EXPAND_PAGE, expand=True):
+            study = item['ParentStudy']
+            for id in item['Instances']:
+                tree.add(Dixel(id, level=DicomLevel.INSTANCES),
+                         studies.get(study), study, item['ID'])
+        return tree
+
+    def initialize_compact_inventory(self):
+        # Straight from the id pages, without making any dixels
+        return CompactInventory.from_ids(self.iter_ids())
+
     def exists(self, dixel):
         url = "{}/{}/{}".format(self.url,
                                 str(dixel.level),
@@ -143,72 +688,22 @@ class OrthancProxy(Orthanc):
 
         def find_series(dixel):
             # Return an individual qid, aid
+            query = {'PatientID': dixel.meta['PatientID'],
+                     'SeriesInstanceUID': dixel.meta.get('SeriesInstanceUID'),
+                     'AccessionNumber': dixel.meta['AccessionNumber']}
+            # if dixel.level == DicomLevel.STUDIES:
+            #     query['ModalitiesInStudy'] = 'CT'
+            query.update(kwargs.get('qdict', {}))
 
-            dicom_level = "series"
-
-            def qdict(dixel):
-                qdict = {'PatientID': dixel.meta['PatientID'],
-                         'StudyInstanceUID': '',
-                         'SeriesInstanceUID': dixel.meta.get('SeriesInstanceUID'),
-                         'SeriesDescription': '',
-                         'SeriesNumber': '',
-                         'StudyDate': '',
-                         'StudyTime': '',
-                         'AccessionNumber': dixel.meta['AccessionNumber']}
-                # if dixel.level == DicomLevel.STUDIES:
-                #     qdict['ModalitiesInStudy'] = 'CT'
-                qdict.update(kwargs.get('qdict', {}))
-                return qdict
-
-            query = qdict(dixel)
-
-            data = {'Level': dicom_level,
-                    'Query': query}
-
-            # self.logger.debug(pformat(data))
-
-            url = '{0}/modalities/{1}/query'.format(self.url, self.remote_aet)
-            self.logger.debug(url)
-
-            headers = {"Accept-Encoding": "identity",
-                       "Accept": "application/json"}
-
-            # Does not like session.post for some reason!
-            try:
-                # r = self.session.post(url, json=data, headers=headers)
-                r = requests.post(url, json=data, headers=headers, auth=self.session.auth)
-                self.logger.debug(r.headers)
-                self.logger.debug(r.content)
-                dixel.meta['QID'] = r.json()["ID"]
-            except ConnectionError as e:
-                self.logger.error(e)
-                self.logger.error(e.request.headers)
-                self.logger.error(e.request.body)
-
-            url = '{0}/queries/{1}/answers'.format(self.url, dixel.meta['QID'])
-            r = self.session.get(url)
-
-            answers = r.json()
+            qid, answers = self.find(query)
+            dixel.meta['QID'] = qid
 
             if len(answers)>1:
                 self.logger.warn('Retrieve too many candidate responses, using LAST')
 
-            for aid in answers:
-                url = '{0}/queries/{1}/answers/{2}/content?simplify'.format(self.url, dixel.meta['QID'], aid)
-                # r = self.session.get(url)
-                r = requests.get(url, auth=self.session.auth)
-
-                tags = r.json()
+            for aid, tags in enumerate(answers):
                 logging.debug(pformat(tags))
-
-                dixel.meta.update(tags)
-                dixel.meta['AID'] = aid
-                dixel.meta['OID'] = DixelTools.orthanc_id(tags['PatientID'],
-                                            tags['StudyInstanceUID'],
-                                            tags['SeriesInstanceUID'])
-
-                # A proper series level ID
-                dixel.id = dixel.meta['OID']
+                self.set_answer(dixel, qid, aid, tags)
 
             return dixel
 
@@ -251,6 +746,169 @@ class OrthancProxy(Orthanc):
 
         return dixel
 
+    def find(self, query, level="series"):
+        # Run a C-FIND on the remote and return its qid and a list of
+        # simplified answers, fetched in one expanded request
+        q = {'StudyInstanceUID': '',
+             'SeriesInstanceUID': '',
+             'SeriesDescription': '',
+             'SeriesNumber': '',
+             'StudyDate': '',
+             'StudyTime': '',
+             'PatientID': '',
+             'AccessionNumber': ''}
+        q.update(query)
+        data = {'Level': level,
+                'Query': q}
+
+        url = '{0}/modalities/{1}/query'.format(self.url, self.remote_aet)
+        self.logger.debug(url)
+
+        headers = {"Accept-Encoding": "identity",
+                   "Accept": "application/json"}
+
+        # Does not like session.post for some reason!
+        try:
+            r = requests.post(url, json=data, headers=headers, auth=self.session.auth)
+            self.logger.debug(r.headers)
+            self.logger.debug(r.content)
+            qid = r.json()["ID"]
+        except ConnectionError as e:
+            self.logger.error(e)
+            self.logger.error(e.request.headers)
+            self.logger.error(e.request.body)
+            raise
+
+        url = '{0}/queries/{1}/answers?expand&simplify'.format(self.url, qid)
+        r = self.session.get(url)
+        r.raise_for_status()
+        answers = r.json()
+
+        # Older Orthancs ignore expand and list answer ids
+        if answers and not isinstance(answers[0], dict):
+            content = []
+            for aid in answers:
+                url = '{0}/queries/{1}/answers/{2}/content?simplify'.format(self.url, qid, aid)
+                content.append(requests.get(url, auth=self.session.auth).json())
+            answers = content
+
+        return qid, answers
+
+    def set_answer(self, dixel, qid, aid, tags):
+        dixel.meta.update(tags)
+        dixel.meta['QID'] = qid
+        dixel.meta['AID'] = str(aid)
+        dixel.meta['OID'] = DixelTools.orthanc_id(tags['PatientID'],
+                                                  tags['StudyInstanceUID'],
+                                                  tags['SeriesInstanceUID'])
+        # A proper series level ID
+        dixel.id = dixel.meta['OID']
+
+    def find_groups(self, worklist, batch):
+        # Split a worklist into ([(query, dixels)], rest) for batched lookups,
+        # by PatientID or by FIND_DAYS wide StudyDate ranges
+        groups = {}
+        rest = []
+        for dixel in worklist:
+            key = dixel.meta.get(batch)
+            if not key or not dixel.meta.get('AccessionNumber') or \
+                    dixel.meta.get('RetrieveAETitle'):
+                rest.append(dixel)
+            else:
+                groups.setdefault(key, []).append(dixel)
+
+        if batch == 'PatientID':
+            return [({'PatientID': k}, v) for k, v in groups.items()], rest
+        elif batch != 'StudyDate':
+            raise ValueError("Can't batch lookups by {0}".format(batch))
+
+        res = []
+        for key in sorted(groups):
+            try:
+                date = datetime.strptime(key, '%Y%m%d')
+            except ValueError:
+                rest.extend(groups[key])
+                continue
+            if res and date <= end:
+                res[-1][1].extend(groups[key])
+                res[-1][0]['StudyDate'] = '{0}-{1}'.format(start.strftime('%Y%m%d'), key)
+            else:
+                start, end = date, date + timedelta(days=FIND_DAYS - 1)
+                res.append(({'StudyDate': key}, list(groups[key])))
+        return res, rest
+
+    def prefetched(self, worklist, workers=1):
+        # Updates are PACS lookups, so there are no tags to prefetch from
+        # this Orthanc, and no reason to list it
+        return worklist
+
+    def update_worklist(self, worklist, workers=1, batch=None, journal=None, **kwargs):
+        # With batch='PatientID' or batch='StudyDate', accession lookups run
+        # as one C-FIND per patient or per date range instead of one per
+        # dixel, and the answers are matched back by AccessionNumber (and
+        # SeriesInstanceUID, where it is known).  Batched lookups don't check
+        # the local Orthanc first.  Anything that can't be grouped, or has no
+        # answer in its group (ie, if the PACS capped the results), is looked
+        # up one at a time.  The journal is keyed by the ids dixels had before
+        # their lookup, as a match replaces them with series ids.
+        if not batch:
+            return super(OrthancProxy, self).update_worklist(
+                worklist, workers=workers, journal=journal, **kwargs)
+
+        finished = journal.done('update') if journal is not None else {}
+        res = set()
+        todo = []
+        for dixel in worklist:
+            if dixel.id in finished:
+                if finished[dixel.id]:
+                    res.add(finished[dixel.id])
+            else:
+                todo.append(dixel)
+
+        groups, rest = self.find_groups(todo, batch)
+
+        def find_group(group):
+            query, dixels = group
+            query = dict(query, **kwargs.get('qdict', {}))
+            qid, answers = self.find(query)
+
+            matches = {}
+            for aid, tags in enumerate(answers):
+                matches.setdefault(tags.get('AccessionNumber'), []).append((aid, tags))
+
+            matched = []
+            unmatched = []
+            for dixel in dixels:
+                candidates = [(aid, tags) for aid, tags in matches.get(dixel.meta['AccessionNumber'], [])
+                              if dixel.meta.get('SeriesInstanceUID') in
+                              (None, tags.get('SeriesInstanceUID'))]
+                if len(candidates)>1:
+                    self.logger.warn('Retrieve too many candidate responses, using LAST')
+                if candidates:
+                    matched.append((dixel.id, dixel))
+                    self.set_answer(dixel, qid, *candidates[-1])
+                else:
+                    unmatched.append(dixel)
+            return matched, unmatched
+
+        self.logger.debug('Looking up {0} items in {1} queries'.format(len(todo), len(groups)))
+        for group, found, e in DixelTools.threaded_map(find_group, groups, workers):
+            if e:
+                self.logger.error('Could not look up {0}: {1}'.format(group[0], e))
+                continue
+            matched, unmatched = found
+            for id, dixel in matched:
+                if journal is not None:
+                    journal.record('update', id, dixel)
+                res.add(dixel)
+            rest.extend(unmatched)
+
+        if rest:
+            # PACS lookups, so there are no tags to prefetch from this Orthanc
+            res.update(DixelStorage.update_worklist(
+                self, rest, workers=workers, journal=journal, **kwargs))
+        return res
+
     def copy(self, dixel, dest):
         # Must _retrieve_ first
         self.get(dixel, retrieve=True)
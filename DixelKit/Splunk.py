@@ -1,5 +1,5 @@
-from Dixel import *
-from DixelStorage import DixelStorage
+from .Dixel import *
+from .DixelStorage import DixelStorage
 
 from pprint import pformat
 from splunklib import client, results
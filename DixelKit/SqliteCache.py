@@ -0,0 +1,274 @@
+import sqlite3
+import pickle
+import threading
+import logging
+
+# Columns that get their own index, read from a dixel's meta (or tags)
+INDEXED_KEYS = ['PatientID', 'StudyInstanceUID', 'AccessionNumber']
+
+# Keep IN (...) queries under sqlite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+class SqliteCache(object):
+    # Dict-like stand-in for DixelStorage.cache that keeps each item in sqlite.
+    #
+    # Sets of dixels (ie, inventories) are stored one row per dixel and come
+    # back as an IndexedDixelSet view, so membership, level, and patient
+    # queries run against the index instead of unpickling millions of dixels.
+    # Dicts (ie, FileStorage's file_index) are stored one row per key and
+    # come back as an IndexedDict view.  Anything else is pickled whole under
+    # its item name.
+
+    def __init__(self, db_file):
+        self.logger = logging.getLogger()
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS items (
+                    item  TEXT PRIMARY KEY,
+                    kind  TEXT,
+                    value BLOB);
+                CREATE TABLE IF NOT EXISTS dixels (
+                    item              TEXT,
+                    id                TEXT,
+                    level             TEXT,
+                    PatientID         TEXT,
+                    StudyInstanceUID  TEXT,
+                    AccessionNumber   TEXT,
+                    dixel             BLOB,
+                    PRIMARY KEY (item, id));
+                CREATE TABLE IF NOT EXISTS entries (
+                    item   TEXT,
+                    key    TEXT,
+                    value  BLOB,
+                    PRIMARY KEY (item, key));
+                CREATE INDEX IF NOT EXISTS dixels_level ON dixels (item, level);
+                CREATE INDEX IF NOT EXISTS dixels_patient ON dixels (item, PatientID);
+                CREATE INDEX IF NOT EXISTS dixels_study ON dixels (item, StudyInstanceUID);
+                CREATE INDEX IF NOT EXISTS dixels_accession ON dixels (item, AccessionNumber);
+                """)
+
+    # Always "loaded", so check_cache never tries to unpickle anything
+    def __nonzero__(self):
+        return True
+    __bool__ = __nonzero__
+
+    def __contains__(self, item):
+        return self.get(item) is not None
+
+    def __getitem__(self, item):
+        value = self.get(item)
+        if value is None:
+            raise KeyError(item)
+        return value
+
+    def get(self, item, default=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT kind, value FROM items WHERE item = ?", (item,)).fetchone()
+        if not row:
+            return default
+        kind, value = row
+        if kind == 'dixels':
+            return IndexedDixelSet(self, item)
+        if kind == 'dict':
+            return IndexedDict(self, item)
+        return pickle.loads(bytes(value))
+
+    def __setitem__(self, item, value):
+        if isinstance(value, (IndexedDixelSet, IndexedDict)):
+            if value.cache is self and value.item == item:
+                # Already stored, ie, a view that was updated in place
+                return
+            value = list(value) if isinstance(value, IndexedDixelSet) else dict(value.iteritems())
+        with self.lock:
+            self.conn.execute("DELETE FROM dixels WHERE item = ?", (item,))
+            self.conn.execute("DELETE FROM entries WHERE item = ?", (item,))
+            if value is None:
+                self.conn.execute("DELETE FROM items WHERE item = ?", (item,))
+            elif isinstance(value, (set, frozenset, list)):
+                self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, 'dixels', NULL)", (item,))
+                IndexedDixelSet(self, item).update(value)
+            elif isinstance(value, dict):
+                self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, 'dict', NULL)", (item,))
+                IndexedDict(self, item).update(value)
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, 'pickle', ?)",
+                                  (item, sqlite3.Binary(pickle.dumps(value, 2))))
+
+    def __delitem__(self, item):
+        self[item] = None
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+
+class IndexedDixelSet(object):
+    # Set-like view of the dixels stored under one cache item
+
+    def __init__(self, cache, item):
+        self.cache = cache
+        self.item = item
+
+    def execute(self, q, args=()):
+        with self.cache.lock:
+            return self.cache.conn.execute(q, args).fetchall()
+
+    def __len__(self):
+        return self.execute("SELECT COUNT(*) FROM dixels WHERE item = ?", (self.item,))[0][0]
+
+    # Checked on every access through check_cache, so don't count the rows
+    def __nonzero__(self):
+        return bool(self.execute("SELECT 1 FROM dixels WHERE item = ? LIMIT 1", (self.item,)))
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        # Page through by id, so that the whole set is never held at once
+        last = ''
+        while True:
+            rows = self.execute(
+                "SELECT id, dixel FROM dixels WHERE item = ? AND id > ? ORDER BY id LIMIT ?",
+                (self.item, last, CHUNK_SIZE))
+            if not rows:
+                return
+            for _, value in rows:
+                yield pickle.loads(bytes(value))
+            last = rows[-1][0]
+
+    def __contains__(self, dixel):
+        id = getattr(dixel, 'id', dixel)
+        return bool(self.execute("SELECT 1 FROM dixels WHERE item = ? AND id = ?", (self.item, id)))
+
+    def add(self, dixel):
+        self.update([dixel])
+
+    def update(self, dixels):
+        def row(d):
+            meta = d.meta or {}
+            tags = d.tags or {}
+            return [self.item, d.id, str(d.level)] + \
+                   [meta.get(k, tags.get(k)) for k in INDEXED_KEYS] + \
+                   [sqlite3.Binary(pickle.dumps(d, 2))]
+        with self.cache.lock:
+            self.cache.conn.executemany(
+                "INSERT OR REPLACE INTO dixels VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (row(d) for d in dixels))
+
+    def discard(self, dixel):
+        self.execute("DELETE FROM dixels WHERE item = ? AND id = ?",
+                     (self.item, getattr(dixel, 'id', dixel)))
+
+    def contains_ids(self, ids):
+        # The subset of ids that are present, one query per chunk
+        ids = list(ids)
+        found = set()
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i:i+CHUNK_SIZE]
+            found.update(r[0] for r in self.execute(
+                "SELECT id FROM dixels WHERE item = ? AND id IN ({0})".format(
+                    ",".join("?" * len(chunk))),
+                [self.item] + chunk))
+        return found
+
+    # worklist - view
+    def __rsub__(self, other):
+        other = list(other)
+        found = self.contains_ids(d.id for d in other)
+        return set(d for d in other if d.id not in found)
+
+    # view - worklist
+    def __sub__(self, other):
+        return set(d for d in self if d not in other)
+
+    def find(self, level=None, **kwargs):
+        # Dixels matching a level and/or any of the indexed keys, ie,
+        # find(PatientID="ABC") or find(level=DicomLevel.STUDIES)
+        q = "SELECT dixel FROM dixels WHERE item = ?"
+        args = [self.item]
+        if level is not None:
+            q += " AND level = ?"
+            args.append(str(level))
+        for k, v in kwargs.items():
+            if k not in INDEXED_KEYS:
+                raise ValueError("{0} is not indexed".format(k))
+            q += " AND {0} = ?".format(k)
+            args.append(v)
+        return set(pickle.loads(bytes(r[0])) for r in self.execute(q, args))
+
+
+class IndexedDict(object):
+    # Dict-like view of the entries stored under one cache item, with each
+    # value pickled in its own row
+
+    def __init__(self, cache, item):
+        self.cache = cache
+        self.item = item
+
+    def execute(self, q, args=()):
+        with self.cache.lock:
+            return self.cache.conn.execute(q, args).fetchall()
+
+    def __len__(self):
+        return self.execute("SELECT COUNT(*) FROM entries WHERE item = ?", (self.item,))[0][0]
+
+    def __nonzero__(self):
+        return bool(self.execute("SELECT 1 FROM entries WHERE item = ? LIMIT 1", (self.item,)))
+    __bool__ = __nonzero__
+
+    def __contains__(self, key):
+        return bool(self.execute("SELECT 1 FROM entries WHERE item = ? AND key = ?", (self.item, key)))
+
+    def get(self, key, default=None):
+        rows = self.execute("SELECT value FROM entries WHERE item = ? AND key = ?", (self.item, key))
+        if not rows:
+            return default
+        return pickle.loads(bytes(rows[0][0]))
+
+    def __getitem__(self, key):
+        rows = self.execute("SELECT value FROM entries WHERE item = ? AND key = ?", (self.item, key))
+        if not rows:
+            raise KeyError(key)
+        return pickle.loads(bytes(rows[0][0]))
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __delitem__(self, key):
+        self.execute("DELETE FROM entries WHERE item = ? AND key = ?", (self.item, key))
+
+    def update(self, d):
+        with self.cache.lock:
+            self.cache.conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                ((self.item, k, sqlite3.Binary(pickle.dumps(v, 2))) for k, v in d.items()))
+
+    def pages(self, column):
+        # Paged by key, like IndexedDixelSet
+        last = ''
+        while True:
+            rows = self.execute(
+                "SELECT key, {0} FROM entries WHERE item = ? AND key > ? ORDER BY key LIMIT ?".format(
+                    column),
+                (self.item, last, CHUNK_SIZE))
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][0]
+
+    def iteritems(self):
+        for rows in self.pages('value'):
+            for key, value in rows:
+                yield key, pickle.loads(bytes(value))
+
+    def __iter__(self):
+        # Keys only, without unpickling the values
+        for rows in self.pages('NULL'):
+            for key, _ in rows:
+                yield key
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
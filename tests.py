@@ -1,12 +1,38 @@
+import atexit
+import json
 import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
 from pprint import pformat
-from DixelKit.DixelStorage import CachePolicy
-from DixelKit.FileStorage import FileStorage
+from DixelKit.DixelStorage import CachePolicy, DixelStorage
+from DixelKit.Dixel import Dixel, DicomLevel
+from DixelKit.DixelTree import DixelTree
+from DixelKit.SqliteCache import SqliteCache
+from DixelKit.Compressor import Compressor
+from DixelKit.Journal import Journal
+try:
+    from DixelKit.FileStorage import FileStorage
+except ImportError:
+    # Needs pydicom 0.9 (Python 2), the async tests run on Python 3 without it
+    FileStorage = None
 from DixelKit.Orthanc import Orthanc, OrthancProxy
 from DixelKit.Montage import Montage
 from DixelKit.Splunk import Splunk
 from DixelKit import DixelTools
 
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
 def test_indexer():
 
     orthanc = Orthanc('localhost', 8042)
@@ -79,6 +105,535 @@ def test_mirror():
     # At this point, the original attachment is MOOT, I believe
 
 
+def test_parallel_inventory():
+
+    # Serial and pooled header parsing should agree
+    file_dir = FileStorage("/users/derek/Desktop/Protect3/80", cache_policy=CachePolicy.NONE)
+    file_dir_p = FileStorage("/users/derek/Desktop/Protect3/80", cache_policy=CachePolicy.NONE,
+                             workers=None, chunksize=8)
+    assert( file_dir.inventory == file_dir_p.inventory )
+    assert( len(file_dir_p.inventory) == 119 )
+
+
+def test_concurrent_copy():
+
+    file_dir = FileStorage("/users/derek/Desktop/Protect3/80", cache_policy=CachePolicy.USE_CACHE)
+    orthanc = Orthanc('localhost', 8042)
+    orthanc.delete_inventory()
+
+    results = {}
+    copied = file_dir.copy_inventory(orthanc, workers=8, queue_size=16, results=results)
+    assert( copied == 119 )
+    assert( len(results) == 119 )
+    assert( not any(results.values()) )
+
+
+def test_export():
+
+    # Assumes test_concurrent_copy has filled the orthanc
+    orthanc = Orthanc('localhost', 8042)
+    out = tempfile.mkdtemp()
+
+    # Instance by instance, then as study archives
+    exported = FileStorage(out, cache_policy=CachePolicy.NONE)
+    copied = orthanc.copy_inventory(exported, workers=8)
+    assert( copied == 119 )
+    assert( len(exported.inventory) == 119 )
+
+    studies = set(orthanc.iter_inventory(DicomLevel.STUDIES))
+    archived = FileStorage(os.path.join(out, "archived"), cache_policy=CachePolicy.NONE)
+    os.makedirs(archived.loc)
+    orthanc.copy_worklist(archived, studies, workers=4)
+    assert( archived.inventory == exported.inventory )
+
+    shutil.rmtree(out)
+
+
+def make_tree(series):
+    # {series id: [instance ids]}, all in one study
+    tree = DixelTree()
+    for se, ids in series.items():
+        for id in ids:
+            tree.add(Dixel(id, level=DicomLevel.INSTANCES), "P", "S", se)
+    return tree
+
+
+def test_tree_difference():
+
+    # Same number of instances, but not the same ones
+    src = make_tree({"A": ["a1", "a2", "a3"], "B": ["b1"]})
+    dest = make_tree({"A": ["a1", "a2", "x9"]})
+    missing = src.difference(dest, DicomLevel.SERIES)
+    assert( sorted(d.id for d in missing) == ["B", "a3"] )
+    assert( sorted(d.id for d in src.reconcile(dest)) == ["a3", "b1"] )
+    assert( not src.difference(src) )
+
+
+def test_tree_rollup():
+
+    tree = make_tree({"A": ["a1", "a2"], "B": ["b1", "b2"]})
+    worklist = [tree.nodes[id] for id in ["a1", "a2", "b1"]]
+    expected = ["A", "b1"]
+    assert( sorted(d.id for d in tree.rollup(set(worklist), DicomLevel.SERIES)) == expected )
+    assert( sorted(d.id for d in tree.rollup(iter(worklist), DicomLevel.SERIES)) == expected )
+    assert( [d.id for d in tree.rollup(worklist + [tree.nodes["b2"]])] == ["S"] )
+
+
+def test_sqlite_cache():
+
+    out = tempfile.mkdtemp()
+    cache = SqliteCache(os.path.join(out, "cache.db"))
+    try:
+        cache['inventory'] = set()
+        assert( not cache['inventory'] )
+
+        # More ids than fit in one IN (...) query or one page
+        inventory = set(Dixel("%04d" % i, meta={'PatientID': "p%d" % (i % 3)},
+                              level=DicomLevel.INSTANCES) for i in range(1200))
+        cache['inventory'] = inventory
+        view = cache['inventory']
+        assert( view and len(view) == 1200 )
+        assert( set(view) == inventory )
+        assert( Dixel("0042") in view and "1300" not in view )
+
+        worklist = set(Dixel("%04d" % i) for i in range(600, 1800))
+        missing = worklist - view
+        assert( isinstance(missing, set) )
+        assert( sorted(d.id for d in missing) == ["%04d" % i for i in range(1200, 1800)] )
+        assert( len(view - worklist) == 600 )
+
+        assert( len(view.find(PatientID="p1")) == 400 )
+        assert( not view.find(level=DicomLevel.SERIES) )
+        try:
+            view.find(Modality="CT")
+            assert( False )
+        except ValueError:
+            pass
+
+        # Putting an updated view back is a no-op, not a wipe and reload
+        view.add(Dixel("9999", level=DicomLevel.INSTANCES))
+        view.discard("0000")
+        cache['inventory'] = view
+        assert( len(cache['inventory']) == 1200 and "9999" in cache['inventory'] )
+        cache['copy'] = view
+        assert( len(cache['copy']) == 1200 )
+
+        cache['file_index'] = {}
+        assert( not cache['file_index'] )
+        cache['file_index'] = {"/a": (1, None), "/b": (2, "b")}
+        file_index = cache['file_index']
+        assert( file_index and len(file_index) == 2 )
+        file_index["/c"] = (3, "c")
+        del file_index["/a"]
+        assert( "/a" not in file_index and file_index.get("/a") is None )
+        try:
+            file_index["/a"]
+            assert( False )
+        except KeyError:
+            pass
+        cache['file_index'] = file_index
+        assert( list(cache['file_index']) == ["/b", "/c"] )
+        assert( list(file_index.iteritems()) == [("/b", (2, "b")), ("/c", (3, "c"))] )
+        assert( [v for _, v in file_index.itervalues()] == ["b", "c"] )
+    finally:
+        shutil.rmtree(out)
+
+
+def test_journal():
+
+    out = tempfile.mkdtemp()
+    fn = os.path.join(out, "job.journal")
+    worklist = [Dixel(str(i), level=DicomLevel.INSTANCES) for i in range(10)]
+    src, dest = DixelStorage(), DixelStorage()
+    copied = []
+
+    def copy(dixel, dest):
+        if dixel.id == "5":
+            raise IOError("killed")
+        copied.append(dixel.id)
+
+    src.copy = copy
+    try:
+        with Journal(fn, sync_every=2) as journal:
+            try:
+                src.copy_worklist(dest, worklist, journal=journal)
+                assert( False )
+            except IOError:
+                pass
+        assert( copied == ["0", "1", "2", "3", "4"] )
+
+        # A record torn off by a kill is dropped, and truncated so that new
+        # records follow the last good one
+        size = os.path.getsize(fn)
+        with open(fn, 'ab') as f:
+            f.write(b'\x80\x02(U\x04copy')
+        journal = Journal(fn)
+        assert( sorted(journal.done('copy')) == ["0", "1", "2", "3", "4"] )
+        assert( os.path.getsize(fn) == size )
+
+        # The restart only copies what's left
+        del copied[:]
+        src.copy = lambda dixel, dest: copied.append(dixel.id)
+        with journal:
+            assert( src.copy_worklist(dest, set(worklist), journal=journal) == 5 )
+        assert( sorted(copied) == ["5", "6", "7", "8", "9"] )
+        with Journal(fn) as journal:
+            assert( len(journal) == 10 )
+    finally:
+        shutil.rmtree(out)
+
+
+def test_dedup():
+
+    if FileStorage is None:
+        import pytest
+        pytest.skip("FileStorage needs pydicom 0.9")
+    import dicom
+    testfiles = os.path.join(os.path.dirname(dicom.__file__), "testfiles")
+
+    # The same instance exported twice
+    out = tempfile.mkdtemp()
+    os.makedirs(os.path.join(out, "cd"))
+    shutil.copy(os.path.join(testfiles, "CT_small.dcm"), out)
+    shutil.copy(os.path.join(testfiles, "CT_small.dcm"), os.path.join(out, "cd", "copy.dcm"))
+    shutil.copy(os.path.join(testfiles, "MR_small.dcm"), out)
+
+    empty = tempfile.mkdtemp()
+    file_dir = FileStorage(out, cache_policy=CachePolicy.NONE, checksum=True)
+    dest = FileStorage(empty, cache_policy=CachePolicy.NONE)
+    try:
+        for lazy in [False, True]:
+            copied = []
+            file_dir.copy = lambda dixel, dest: copied.append(dixel.meta['full_path'])
+            assert( file_dir.copy_inventory(dest, lazy=lazy) == 2 )
+            # The first path in sorted order is the one that's kept
+            assert( sorted(copied) == [os.path.join(out, "CT_small.dcm"),
+                                       os.path.join(out, "MR_small.dcm")] )
+            assert( list(file_dir.duplicates.values()) == [[os.path.join(out, "cd", "copy.dcm")]] )
+            assert( not file_dir.conflicts )
+    finally:
+        shutil.rmtree(out)
+        shutil.rmtree(empty)
+
+
+def test_copy_to_files():
+
+    if FileStorage is None:
+        import pytest
+        pytest.skip("FileStorage needs pydicom 0.9")
+    import dicom
+    with open(os.path.join(os.path.dirname(dicom.__file__), "testfiles", "CT_small.dcm"), 'rb') as f:
+        data = f.read()
+
+    def respond(method, path, query, body):
+        if path == '/instances/x/file':
+            return 200, data
+        return 404, {}
+
+    out = tempfile.mkdtemp()
+    try:
+        orthanc = Orthanc('127.0.0.1', run_standin(respond))
+        files = FileStorage(out, cache_policy=CachePolicy.NONE)
+        assert( orthanc.copy_worklist(files, [Dixel('x', level=DicomLevel.INSTANCES)]) == 1 )
+        assert( len(files.inventory) == 1 )
+        assert( not [fn for fn in os.listdir(out) if fn.startswith('.')] )
+    finally:
+        shutil.rmtree(out)
+
+
+def test_colocated_update():
+
+    if FileStorage is None:
+        import pytest
+        pytest.skip("FileStorage needs pydicom 0.9")
+    import dicom
+    from DixelKit import Orthanc as orthanc_module
+
+    # One attachment on disk that every instance points to, and an index
+    # that knows about it
+    loc = tempfile.mkdtemp()
+    uuid = "abcd0123"
+    os.makedirs(os.path.join(loc, "ab", "cd"))
+    shutil.copy(os.path.join(os.path.dirname(dicom.__file__), "testfiles", "CT_small.dcm"),
+                os.path.join(loc, "ab", "cd", uuid))
+    index = sqlite3.connect(os.path.join(loc, "index"), isolation_level=None)
+    index.executescript("""
+        CREATE TABLE Resources (internalId INTEGER, resourceType INTEGER, publicId TEXT);
+        CREATE TABLE AttachedFiles (id INTEGER, fileType INTEGER, uuid TEXT, compressionType INTEGER);""")
+    for i in range(5):
+        index.execute("INSERT INTO Resources VALUES (?, 4, ?)", (i, "i%d" % i))
+        index.execute("INSERT INTO AttachedFiles VALUES (?, 1, ?, 1)", (i, uuid))
+
+    requests = []
+
+    def respond(method, path, query, body):
+        requests.append(path)
+        if path.endswith('/attachments/dicom/uuid'):
+            return 200, uuid
+        return 404, {}
+
+    class Warnings(logging.Handler):
+        def emit(self, record):
+            if record.levelno >= logging.WARNING:
+                warnings.append(record.getMessage())
+    warnings = []
+    handler = Warnings()
+    logging.getLogger().addHandler(handler)
+
+    orthanc = Orthanc('127.0.0.1', run_standin(respond),
+                      storage=FileStorage(loc, cache_policy=CachePolicy.NONE))
+    update_batch, orthanc_module.UPDATE_BATCH = orthanc_module.UPDATE_BATCH, 2
+    try:
+        def update():
+            worklist = (Dixel("i%d" % i, level=DicomLevel.INSTANCES) for i in range(5))
+            res = orthanc.update_worklist(worklist)
+            assert( len(res) == 5 )
+            assert( all(d.meta['PatientID'] == "1CT1" for d in res) )
+
+        # Looked up in the index a chunk at a time, and read from disk
+        update()
+        assert( not requests and not warnings )
+
+        # A running Orthanc keeps its index locked, so there's one warning
+        # and then a REST request per instance for its uuid
+        index.execute("BEGIN EXCLUSIVE")
+        update()
+        assert( len(requests) == 5 )
+        assert( len(warnings) == 1 and "index" in warnings[0] )
+    finally:
+        orthanc_module.UPDATE_BATCH = update_batch
+        logging.getLogger().removeHandler(handler)
+        index.close()
+        shutil.rmtree(loc)
+
+
+def test_tree_listing():
+
+    # Two studies with two series each, listed a page at a time
+    from DixelKit import Orthanc as orthanc_module
+    resources = {
+        'studies': [{'ID': 'st%d' % i, 'ParentPatient': 'p'} for i in range(2)],
+        'series': [{'ID': 'se%d%d' % (i, j), 'ParentStudy': 'st%d' % i,
+                    'Instances': ['i%d%d%d' % (i, j, k) for k in range(3)]}
+                   for i in range(2) for j in range(2)]}
+    pages = []
+
+    def respond(method, path, query, body):
+        level = path.strip('/')
+        if level not in resources or 'expand' not in query:
+            return 404, {}
+        pages.append(level)
+        since, limit = int(query['since']), int(query['limit'])
+        return 200, resources[level][since:since+limit]
+
+    orthanc = Orthanc('127.0.0.1', run_standin(respond))
+    expand_page, orthanc_module.EXPAND_PAGE = orthanc_module.EXPAND_PAGE, 1
+    try:
+        tree = orthanc.initialize_tree()
+    finally:
+        orthanc_module.EXPAND_PAGE = expand_page
+    assert( pages == ['studies'] * 3 + ['series'] * 5 )
+    assert( len(tree.nodes['st1'].children) == 2 )
+    assert( tree.nodes['i110'].parent.id == 'se11' )
+
+
+def fake_transcode(full_path):
+    # Stands in for gdcm in the pool, tags the output with the worker's pid
+    with open(full_path, 'rb') as f:
+        data = f.read()
+    return data + str(os.getpid()).encode()
+
+
+def test_compressor():
+
+    out = tempfile.mkdtemp()
+    valid = os.path.join(out, "valid.dcm")
+    with open(valid, 'wb') as f:
+        f.write(b'\0' * 128 + b'DICM' + b'data')
+    invalid = os.path.join(out, "invalid.dcm")
+    with open(invalid, 'wb') as f:
+        f.write(b'not dicom')
+
+    compressor = Compressor(backend="gdcm", workers=2, transcode=fake_transcode)
+    try:
+        results = [compressor.compress(valid) for _ in range(20)]
+        assert( all(r.startswith(b'\0' * 128 + b'DICMdata') for r in results) )
+        # The same few workers handle every file
+        assert( len(set(r[136:] for r in results)) <= 2 )
+        try:
+            compressor.compress(invalid)
+            assert( False )
+        except ValueError:
+            pass
+    finally:
+        compressor.close()
+        shutil.rmtree(out)
+
+
+def run_standin(respond):
+    # Serve respond(method, path, query, body) -> (status, json, text or
+    # bytes) from a background thread, returns the port
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def handle_any(self):
+            u = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            query = dict((k, v[0]) for k, v in parse_qs(u.query, keep_blank_values=True).items())
+            status, res = respond(self.command, u.path, query, body)
+            if isinstance(res, bytes):
+                out = res
+            else:
+                out = (res if isinstance(res, str) else json.dumps(res)).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        do_GET = do_POST = do_DELETE = handle_any
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    # Stopped before the interpreter tears down the modules it's using
+    atexit.register(server.shutdown)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server.server_port
+
+
+def async_storage():
+    # AsyncStorage is the Python 3.5+ part of the package
+    if sys.version_info < (3, 5):
+        import pytest
+        pytest.skip("AsyncStorage needs Python 3.5+")
+    import asyncio
+    from DixelKit import AsyncStorage
+    return asyncio.new_event_loop(), AsyncStorage
+
+
+def test_async_orthanc():
+
+    loop, AsyncStorage = async_storage()
+    instances = {}
+    stored = []
+    pages = []
+
+    def respond(method, path, query, body):
+        parts = path.split('/')
+        if method == 'POST' and path == '/instances/':
+            id = body.decode()
+            instances[id] = id
+            return 200, {'ID': id, 'Status': 'Success'}
+        if method == 'POST' and parts[1] == 'peers':
+            stored.append(body.decode())
+            return 200, {}
+        if method == 'DELETE':
+            del instances[parts[2]]
+            return 200, {}
+        if path == '/instances':
+            pages.append(query)
+            since = int(query.get('since', 0))
+            limit = int(query.get('limit', len(instances)))
+            return 200, sorted(instances)[since:since+limit]
+        if path == '/changes':
+            return 200, {'Changes': [], 'Done': True, 'Last': 0}
+        if parts[-1] == 'file':
+            return 200, instances[parts[2]]
+        if parts[-1] == 'tags':
+            return 200, {'PatientID': 'p', 'SOPInstanceUID': instances[parts[2]],
+                         'StudyDate': '20180101', 'StudyTime': '120000'}
+        if parts[-2:-1] == ['metadata']:
+            return 200, {'TransferSyntax': '1.2.840.10008.1.2.1',
+                         'SopClassUid': '1.2.840.10008.5.1.4.1.1.2'}[parts[-1]]
+        return 404, {}
+
+    port = run_standin(respond)
+    run = loop.run_until_complete
+    orthanc = AsyncStorage.wrap(Orthanc('127.0.0.1', port), concurrency=16)
+    try:
+        for i in range(200):
+            run(orthanc.aput(Dixel(str(i), data={'file': str(i).encode()})))
+        inventory = run(orthanc.ainventory())
+        assert( len(inventory) == 200 )
+        assert( len(pages) == 1 and pages[0]['limit'] )
+
+        # Listed LIST_PAGE at a time
+        list_page, AsyncStorage.LIST_PAGE = AsyncStorage.LIST_PAGE, 64
+        try:
+            assert( run(orthanc.ainventory()) == inventory )
+        finally:
+            AsyncStorage.LIST_PAGE = list_page
+        assert( [int(q['since']) for q in pages[1:]] == [0, 64, 128, 192] )
+
+        updated = run(orthanc.aupdate_worklist(inventory))
+        assert( len(updated) == 200 )
+        d = sorted(updated)[0]
+        assert( d.meta['SOPClassUID'] == 'CT Image Storage' )
+        assert( d.meta['StudyDateTime'].year == 2018 )
+
+        peer = Orthanc('127.0.0.1', port, peer_name='peer')
+        results = {}
+        copied = run(orthanc.acopy_worklist(peer, inventory, results=results))
+        assert( copied == 200 )
+        assert( len(stored) == 200 )
+        assert( not any(results.values()) )
+
+        # Delegated to the sync get, which streams the file
+        d = run(orthanc.aget(Dixel('7', level=DicomLevel.INSTANCES)))
+        assert( b''.join(d.data['file']) == b'7' )
+
+        # Sync API still works on the wrapper
+        assert( len(orthanc.inventory) == 200 )
+
+        run(orthanc.amap(orthanc.adelete, inventory))
+        assert( len(run(orthanc.ainventory())) == 0 )
+    finally:
+        run(orthanc.close())
+        loop.close()
+
+
+def test_async_montage():
+
+    loop, AsyncStorage = async_storage()
+
+    def respond(method, path, query, body):
+        if path == '/api/v1/index':
+            return 200, {}
+        patient_id, accession_number = query['q'].split('+')
+        return 200, {'objects': [{
+            'id': 1,
+            'accession_number': accession_number,
+            'patient_age': 50,
+            'patient_first_name': 'first',
+            'patient_last_name': 'last',
+            'text': 'report for {0}'.format(accession_number),
+            'exam_type': {'code': 'IMG1'},
+            'events': [{'event_type': 5, 'date': '2018-01-01'}]}]}
+
+    port = run_standin(respond)
+    run = loop.run_until_complete
+    montage = AsyncStorage.wrap(Montage('127.0.0.1', port))
+    try:
+        worklist = set(Dixel(str(i), meta={'PatientID': 'p',
+                                           'AccessionNumber': str(i),
+                                           'ReferenceTime': '2018-01-01'})
+                       for i in range(100))
+        updated = run(montage.aupdate_worklist(worklist, time_delta="+1d"))
+        assert( len(updated) == 100 )
+        assert( all(d.meta['Report'] == 'report for {0}'.format(d.id) for d in updated) )
+    finally:
+        run(montage.close())
+        loop.close()
+
+
 def test_pacs_lookup():
 
     splunk = Splunk()